@@ -0,0 +1,89 @@
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+
+from eapprocessor.cadence.parse import parse_lcadc, DEFAULT_CHUNK_SIZE
+
+DEFAULT_CACHE_DIR = Path("./output/cache/cadence")
+DEFAULT_CACHE_SIZE = 2 * 1024**3
+
+
+def get_cache_key(filepath, time_threshold=1e-8, t_start=None, t_stop=None):
+    """Key of parsed values, changes when the source or parameters change."""
+
+    filepath = Path(filepath).resolve()
+    stat = filepath.stat()
+    identity = repr((str(filepath), stat.st_size, stat.st_mtime_ns,
+                     float(time_threshold), t_start, t_stop))
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def parse_lcadc_cached(filepath, time_threshold=1e-8, t_start=None,
+                       t_stop=None, cache_dir=DEFAULT_CACHE_DIR,
+                       max_size=DEFAULT_CACHE_SIZE,
+                       chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parse a waveform as parse_lcadc, reusing previous results.
+
+    Times and values are stored as a binary array in cache_dir, so loading
+    them again is a memory-mapped read. Least recently used entries are
+    removed while the cache is larger than max_size bytes.
+    """
+
+    cache_dir = Path(cache_dir)
+    key = get_cache_key(filepath, time_threshold=time_threshold,
+                        t_start=t_start, t_stop=t_stop)
+    cache_file = cache_dir / f'{key}.npy'
+
+    if cache_file.exists():
+        # Modification time keeps the order of use for eviction
+        os.utime(cache_file)
+        events = load_events(cache_file)
+        return events[0], events[1]
+
+    time, value = parse_lcadc(filepath, time_threshold=time_threshold,
+                              t_start=t_start, t_stop=t_stop,
+                              chunk_size=chunk_size)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    temporary = cache_dir / f'{key}.{os.getpid()}.tmp'
+    with open(temporary, 'wb') as f:
+        np.save(f, np.stack((time, value)).astype(np.float64))
+    os.replace(temporary, cache_file)
+    evict_cache(cache_dir, max_size=max_size, keep=cache_file)
+
+    events = load_events(cache_file)
+    return events[0], events[1]
+
+
+def load_events(cache_file):
+
+    try:
+        return np.load(cache_file, mmap_mode='r')
+    except ValueError:
+        # Empty arrays cannot be memory-mapped
+        return np.load(cache_file)
+
+
+def evict_cache(cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE,
+                keep=None):
+    """Remove least recently used entries until the cache fits max_size."""
+
+    entries = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry)
+               for entry in Path(cache_dir).glob('*.npy')]
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_size:
+            break
+        if keep is not None and entry == Path(keep):
+            continue
+        entry.unlink(missing_ok=True)
+        total -= size
+
+    return total
+
+
+def clear_cache(cache_dir=DEFAULT_CACHE_DIR):
+
+    return evict_cache(cache_dir, max_size=0)
@@ -0,0 +1,84 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+import numpy as np
+
+from eapprocessor.cadence.parse import parse_signals, DEFAULT_CHUNK_SIZE
+from eapprocessor.multi import NUM_CORES, MULTI_ENABLED
+from eapprocessor.tools.ragged import RaggedArray
+
+
+def ingest_cadence_files(files, time_threshold=1e-8, t_start=None,
+                         t_stop=None,
+                         n_workers=NUM_CORES if MULTI_ENABLED else 1,
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parse every signal of several waveform exports into one event store.
+
+    Each file is parsed in a single pass with parse_signals, in a pool of
+    n_workers processes, by default only when MULTI_ENABLED. Rows of the
+    store are (file, signal) pairs in the order of files and of signals
+    inside each file.
+
+    :return: dictionary with files, file index and signal name of each row,
+        and time and value of events as ragged arrays sharing offsets
+    """
+
+    files = [str(Path(filepath).resolve()) for filepath in files]
+    parse = partial(parse_signals, time_threshold=time_threshold,
+                    t_start=t_start, t_stop=t_stop, chunk_size=chunk_size)
+
+    if n_workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers,
+                                                 len(files))) as pool:
+            parsed = list(pool.map(parse, files))
+    else:
+        parsed = [parse(filepath) for filepath in files]
+
+    file_index = []
+    signals = []
+    times = []
+    values = []
+    for idx, (names, file_times, file_values) in enumerate(parsed):
+        file_index += [idx] * len(names)
+        signals += names
+        times += file_times
+        values += file_values
+
+    time = RaggedArray.from_arrays(times, dtype=np.float64)
+    value = RaggedArray(RaggedArray.from_arrays(values,
+                                                dtype=np.float64).values,
+                        time.offsets)
+
+    return {"files": files,
+            "file": np.array(file_index, dtype=int),
+            "signal": signals,
+            "time": time,
+            "value": value}
+
+
+def ingest_cadence_folder(folder, pattern="*.vcsv", **kwargs):
+    """Parse every waveform export of a folder, see ingest_cadence_files."""
+
+    folder = Path(folder).resolve()
+    files = sorted(folder.rglob(pattern))
+    if len(files) == 0:
+        raise AttributeError(folder, " contains no waveform exports")
+
+    return ingest_cadence_files(files, **kwargs)
+
+
+def get_signal_events(store, filepath, signal):
+    """Get times and values of a signal of a file, views of the store."""
+
+    files = store["files"]
+    if isinstance(filepath, (int, np.integer)):
+        file_idx = filepath
+    else:
+        file_idx = files.index(str(Path(filepath).resolve()))
+
+    for row, (row_file, row_signal) in enumerate(zip(store["file"],
+                                                     store["signal"])):
+        if row_file == file_idx and row_signal == signal:
+            return store["time"][row], store["value"][row]
+
+    raise AttributeError(f"Signal {signal} not found in {files[file_idx]}")
@@ -2,22 +2,172 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
+DEFAULT_CHUNK_SIZE = 1000000
 
-def parse_lcadc(filepath, time_threshold=1e-8, t_start=None, t_stop=None):
-    df = pd.read_csv(Path(filepath), comment=';', header=None,
-                     names=["time_VOUT", "VOUT"])
-    df["delayed"] = df["VOUT"].shift(periods=1, fill_value=0)
-    df["abs_diff"] = np.absolute(df["VOUT"] - df["delayed"])
 
-    ndf = df.loc[df["abs_diff"] != 0].copy()
-    ndf["time_diff"] = ndf["time_VOUT"].shift(
-        periods=-1, fill_value=0) - ndf["time_VOUT"]
-    sel_df = ndf.loc[ndf["time_diff"] > time_threshold].copy()
+def parse_lcadc(filepath, time_threshold=1e-8, t_start=None, t_stop=None,
+                chunk_size=DEFAULT_CHUNK_SIZE):
 
-    if t_start is not None:
-        sel_df = sel_df[(sel_df["time_VOUT"] >= t_start)].copy()
+    times = [np.array([])]
+    values = [np.array([])]
+    for chunk_times, chunk_values in parse_lcadc_chunks(
+            filepath, time_threshold=time_threshold, t_start=t_start,
+            t_stop=t_stop, chunk_size=chunk_size):
+        times += [chunk_times]
+        values += [chunk_values]
+
+    return np.concatenate(times), np.concatenate(values)
+
+
+def parse_lcadc_chunks(filepath, time_threshold=1e-8, t_start=None,
+                       t_stop=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield selected change events of a waveform reading chunk by chunk.
+
+    An event is a sample whose value differs from the previous one, the
+    first one compared with 0. It is selected when the next event is more
+    than time_threshold later and its time is inside [t_start, t_stop].
+    Only one chunk is in memory at a time; the previous value and the last
+    event, still waiting for the next one, are carried between chunks.
+    Times must be increasing, so reading stops once past t_stop.
+    """
+
+    reader = pd.read_csv(Path(filepath), comment=';', header=None,
+                         names=["time_VOUT", "VOUT"], chunksize=chunk_size)
+
+    state = get_events_state()
+    with reader:
+        for chunk in reader:
+            yield select_chunk_events(chunk["time_VOUT"].to_numpy(),
+                                      chunk["VOUT"].to_numpy(), state,
+                                      time_threshold=time_threshold,
+                                      t_start=t_start, t_stop=t_stop)
+            if state["done"]:
+                return
+
+    yield finish_events(state, time_threshold=time_threshold,
+                        t_start=t_start, t_stop=t_stop)
+
+
+def parse_signals(filepath, time_threshold=1e-8, t_start=None, t_stop=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parse change events of every signal of a waveform export at once.
+
+    Columns are pairs of time and value of each signal, as exported to
+    .vcsv, and every pair is selected as parse_lcadc does in the same pass
+    over the file. Signals with fewer samples have empty trailing cells.
+
+    :return: names of signals, and times and values of events per signal
+    """
+
+    filepath = Path(filepath)
+    names = read_signal_names(filepath)
+    reader = pd.read_csv(filepath, comment=';', header=None,
+                         chunksize=chunk_size)
+
+    states = None
+    times = None
+    values = None
+    with reader:
+        for chunk in reader:
+            columns = chunk.to_numpy(dtype=np.float64)
+            if states is None:
+                n_signals = columns.shape[1] // 2
+                states = [get_events_state() for _ in range(n_signals)]
+                times = [[np.array([])] for _ in range(n_signals)]
+                values = [[np.array([])] for _ in range(n_signals)]
+
+            for idx, state in enumerate(states):
+                if state["done"]:
+                    continue
+                time = columns[:, 2 * idx]
+                value = columns[:, 2 * idx + 1]
+                filled = ~np.isnan(time)
+                time, value = select_chunk_events(
+                    time[filled], value[filled], state,
+                    time_threshold=time_threshold,
+                    t_start=t_start, t_stop=t_stop)
+                times[idx] += [time]
+                values[idx] += [value]
+
+            if all(state["done"] for state in states):
+                break
+
+    if states is None:
+        return [], [], []
+
+    for idx, state in enumerate(states):
+        time, value = finish_events(state, time_threshold=time_threshold,
+                                    t_start=t_start, t_stop=t_stop)
+        times[idx] = np.concatenate(times[idx] + [time])
+        values[idx] = np.concatenate(values[idx] + [value])
+
+    names = names[:len(states)] + [f'signal_{idx}' for idx in
+                                   range(len(names), len(states))]
+    return names, times, values
 
-    if t_stop is not None:
-        sel_df = sel_df[(sel_df["time_VOUT"] <= t_stop)].copy()
 
-    return np.array(sel_df["time_VOUT"]), np.array(sel_df["VOUT"])
+def read_signal_names(filepath):
+
+    # Header of .vcsv files: version, signal names, kind of columns, ...
+    header = []
+    with open(filepath) as f:
+        for line in f:
+            if not line.startswith(';'):
+                break
+            header += [line[1:].strip()]
+
+    if len(header) < 2:
+        return []
+    return [name.strip() for name in header[1].split(',')]
+
+
+def get_events_state():
+
+    return {"previous": 0,
+            "pending_time": np.array([]),
+            "pending_value": np.array([]),
+            "done": False}
+
+
+def select_chunk_events(time, value, state, time_threshold=1e-8,
+                        t_start=None, t_stop=None):
+
+    if len(time) == 0:
+        return np.array([]), np.array([])
+
+    changed = value != np.concatenate(([state["previous"]], value[:-1]))
+    state["previous"] = value[-1]
+
+    event_time = np.concatenate((state["pending_time"], time[changed]))
+    event_value = np.concatenate((state["pending_value"], value[changed]))
+    if len(event_time) == 0:
+        return np.array([]), np.array([])
+
+    # Last event is decided when the next one is found
+    keep = np.diff(event_time) > time_threshold
+    state["pending_time"] = event_time[-1:]
+    state["pending_value"] = event_value[-1:]
+    if t_stop is not None and event_time[-1] > t_stop:
+        state["done"] = True
+
+    return select_window(event_time[:-1][keep], event_value[:-1][keep],
+                         t_start=t_start, t_stop=t_stop)
+
+
+def finish_events(state, time_threshold=1e-8, t_start=None, t_stop=None):
+
+    # As the last event of the whole waveform, its next time is 0
+    pending_time = state["pending_time"]
+    keep = (0 - pending_time) > time_threshold
+    return select_window(pending_time[keep], state["pending_value"][keep],
+                         t_start=t_start, t_stop=t_stop)
+
+
+def select_window(time, value, t_start=None, t_stop=None):
+
+    mask = np.ones(len(time), dtype=bool)
+    if t_start is not None:
+        mask &= time >= t_start
+    if t_stop is not None:
+        mask &= time <= t_stop
+    return time[mask], value[mask]
@@ -1,6 +1,24 @@
 #!/bin/python3
+import math
 import numpy as np
-from typing import Union, List, Tuple, Iterable, Callable
+from typing import Union, List, Tuple, Iterable, Callable, Dict
+
+# Element-wise operators accepted by quantize and their ufunc equivalent.
+# Python round and np.rint both round half to even, int truncates to zero.
+UFUNC_OPERATORS = {
+    round: np.rint,
+    int: np.trunc,
+    math.floor: np.floor,
+    math.ceil: np.ceil,
+    math.trunc: np.trunc,
+    np.round: np.rint,
+    np.around: np.rint,
+    np.rint: np.rint,
+    np.floor: np.floor,
+    np.ceil: np.ceil,
+    np.trunc: np.trunc,
+    np.fix: np.trunc,
+}
 
 
 def normalize(array: Union[List[float], np.ndarray],
@@ -17,15 +35,128 @@ def normalize(array: Union[List[float], np.ndarray],
     :rtype: np.ndarray
     """
 
+    values = np.array(array)
+    if values.dtype.kind in 'bui':
+        # Compact integer codes would overflow when doubled
+        values = values.astype(np.float64)
+
     max_values = 2**resolution
     if bipolar:
-        normalized = 2 * np.array(array) / max_values - 1
+        normalized = 2 * values / max_values - 1
     else:
-        normalized = np.array(array) / max_values
+        normalized = values / max_values
 
     return normalized
 
 
+class NormalizedCodes:
+    """Lazy normalized view of converted values.
+
+    Values are normalized when accessed, so the normalized array is not kept
+    in memory nor saved along with the codes. It supports indexing, len and
+    iteration per channel, and conversion with np.array.
+
+    :param codes: converted values, e.g. [channel[converted]] array, HDF5
+        dataset or list of arrays per channel
+    :param resolution: resolution with those were converted
+    :type resolution: int
+    :param bipolar: type of adc
+    :type bipolar: bool
+    :param dtype: floating type of the normalized values
+    :type dtype: type
+    """
+
+    def __init__(self, codes, resolution: int, bipolar: bool = True,
+                 dtype: type = np.float64):
+        self.codes = codes
+        self.resolution = resolution
+        self.bipolar = bipolar
+        self.dtype = dtype
+
+    def __getitem__(self, key):
+        return normalize(self.codes[key], self.resolution,
+                         bipolar=self.bipolar).astype(self.dtype, copy=False)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __array__(self, dtype=None, copy=None):
+        if getattr(self.codes, "dtype", object) != object:
+            normalized = self[()]
+        else:
+            # Channels of LCADC values may have different lengths
+            rows = list(self)
+            if len({len(row) for row in rows}) <= 1:
+                normalized = np.array(rows)
+            else:
+                normalized = np.empty(len(rows), dtype=object)
+                normalized[:] = rows
+        if dtype is not None:
+            normalized = normalized.astype(dtype, copy=False)
+        return normalized
+
+    @property
+    def shape(self):
+        return getattr(self.codes, "shape", (len(self.codes),))
+
+
+def get_code_dtype(resolution: int, low: int = 0,
+                   high: int = None) -> np.dtype:
+    """Get the smallest integer type for codes of a converter.
+
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param low: lowest code to represent
+    :type low: int
+    :param high: highest code to represent, by default 2**resolution - 1
+    :type high: int
+    :return: unsigned type if low is not negative, signed otherwise
+    :rtype: np.dtype
+    """
+
+    high = max(2**resolution - 1, 0 if high is None else high)
+    if low >= 0:
+        candidates = (np.uint8, np.uint16, np.uint32, np.uint64)
+    else:
+        candidates = (np.int8, np.int16, np.int32, np.int64)
+
+    for candidate in candidates:
+        info = np.iinfo(candidate)
+        if info.min <= low and high <= info.max:
+            return np.dtype(candidate)
+
+    return np.dtype(np.int64)
+
+
+def compact_codes(codes: Union[List[int], np.ndarray],
+                  resolution: int) -> np.ndarray:
+    """Store codes with the smallest integer type that fits them.
+
+    The model does not clip values out of the reference, so the actual
+    codes are considered besides the range given by the resolution.
+
+    :param codes: converted values
+    :type codes: Union[List[int], np.ndarray]
+    :param resolution: resolution with those were converted
+    :type resolution: int
+    :return: converted values with compact integer type
+    :rtype: np.ndarray
+    """
+
+    codes = np.asarray(codes)
+    if codes.size == 0:
+        return codes.astype(get_code_dtype(resolution))
+
+    dtype = get_code_dtype(resolution,
+                           low=min(int(codes.min()), 0),
+                           high=int(codes.max()))
+    return codes.astype(dtype, copy=False)
+
+
 def convert_lcadc(array: Union[List[float],
                                np.ndarray],
                   voltage_ref: float,
@@ -97,6 +228,9 @@ def convert_array(array: Union[List[float], np.ndarray],
                   operator: Callable[[float], int] = int) -> np.ndarray:
     """Convert array to numeric values with classic SAR model
 
+    The whole array is quantized at once, so it can be a single channel or a
+    (channels, samples) matrix.
+
     :param array: array of float values
     :type array: Union[List[float], np.ndarray]
     :param voltage_ref: reference for converter
@@ -108,11 +242,11 @@ def convert_array(array: Union[List[float], np.ndarray],
     :return: array of converted values
     :rtype: Tuple[List[int], List[float]]
     """
-    return np.array([quantize(x,
-                              voltage_ref=voltage_ref,
-                              resolution=resolution,
-                              bipolar=bipolar,
-                              operator=operator) for x in array])
+    return quantize_array(array,
+                          voltage_ref=voltage_ref,
+                          resolution=resolution,
+                          bipolar=bipolar,
+                          operator=operator)
 
 
 def dac(value: Union[List[int], np.ndarray, int],
@@ -134,8 +268,7 @@ def dac(value: Union[List[int], np.ndarray, int],
     """
 
     if isinstance(value, (list, np.ndarray)):
-        return np.array([dac(element, voltage_ref, resolution, bipolar)
-                         for element in value])
+        return dac_array(value, voltage_ref, resolution, bipolar)
 
     max_values = 2**resolution
     if bipolar:
@@ -148,6 +281,57 @@ def dac(value: Union[List[int], np.ndarray, int],
     return analog
 
 
+def dac_array(value: Union[List[int], np.ndarray],
+              voltage_ref: Union[float, List[float], np.ndarray],
+              resolution: Union[int, List[int], np.ndarray],
+              bipolar: bool = False,
+              dtype: type = np.float64) -> np.ndarray:
+    """Convert an array of digital values to analog in a single call.
+
+    The array may have any shape. When voltage_ref or resolution are given
+    as one value per channel, they are broadcast along the first axis of
+    value, e.g. a (channels, samples) matrix of codes.
+
+    :param value: Numeric values to be converted to float
+    :type value: Union[List[int], np.ndarray]
+    :param voltage_ref: Reference for converter, scalar or per channel
+    :type voltage_ref: Union[float, List[float], np.ndarray]
+    :param resolution: Resolution for converter, scalar or per channel
+    :type resolution: Union[int, List[int], np.ndarray]
+    :param bipolar: Type of converter
+    :type bipolar: bool
+    :param dtype: Floating type of the output, np.float32 or np.float64
+    :type dtype: type
+    :return: Floating values
+    :rtype: np.ndarray
+    """
+
+    value = np.asarray(value)
+    voltage_ref = _broadcast_per_channel(voltage_ref, value.ndim)
+    resolution = _broadcast_per_channel(resolution, value.ndim)
+
+    # Compute in double precision as dac does, cast only the result
+    max_values = np.power(2.0, resolution)
+    if bipolar:
+        step = 2 * voltage_ref / max_values
+        analog = value * step - voltage_ref
+    else:
+        step = voltage_ref / max_values
+        analog = value * step
+
+    return np.asarray(analog, dtype=np.float64).astype(dtype, copy=False)
+
+
+def _broadcast_per_channel(parameter: Union[float, List[float], np.ndarray],
+                           ndim: int) -> Union[float, np.ndarray]:
+    """Shape a per channel parameter to broadcast along the first axis."""
+
+    parameter = np.asarray(parameter, dtype=np.float64)
+    if parameter.ndim == 0:
+        return float(parameter)
+    return parameter.reshape((-1,) + (1,) * (ndim - 1))
+
+
 def quantize(value: float,
              voltage_ref: float,
              resolution: int,
@@ -177,6 +361,139 @@ def quantize(value: float,
     return quantized
 
 
+def get_ufunc_operator(operator: Callable[[float], int]) -> Callable:
+    """Get the ufunc equivalent to a scalar rounding operator.
+
+    Operators without a known equivalent are wrapped with np.frompyfunc, so
+    they are still applied element-wise, although in interpreted time.
+
+    :param operator: Scalar operator as used by quantize
+    :type operator: Callable[[float], int]
+    :return: Function applied to the whole array
+    :rtype: Callable
+    """
+
+    try:
+        ufunc = UFUNC_OPERATORS.get(operator)
+    except TypeError:
+        ufunc = None
+
+    if ufunc is None:
+        ufunc = np.frompyfunc(operator, 1, 1)
+
+    return ufunc
+
+
+def quantize_array(array: Union[List[float], np.ndarray],
+                   voltage_ref: float,
+                   resolution: int,
+                   bipolar: bool = False,
+                   operator: Callable[[float], int] = int) -> np.ndarray:
+    """Quantize a whole array from analog to digital in a single call.
+
+    The array may have any shape, e.g. a (channels, samples) matrix of
+    recordings. Codes are the same as applying quantize to every element.
+
+    :param array: Floating values to be converted
+    :type array: Union[List[float], np.ndarray]
+    :param voltage_ref: Reference for quantization
+    :type voltage_ref: float
+    :param resolution: Resolution for quantization
+    :type resolution: int
+    :param bipolar: Type of quantization
+    :type bipolar: bool
+    :param operator: Scalar operator, mapped to its ufunc equivalent
+    :type operator: Callable[[float], int]
+    :return: Numeric values corresponding to floating values
+    :rtype: np.ndarray
+    """
+
+    ufunc = get_ufunc_operator(operator)
+    scaled = scale_array(array, voltage_ref=voltage_ref,
+                         resolution=resolution, bipolar=bipolar)
+    return ufunc(scaled).astype(np.int64)
+
+
+def scale_array(array: Union[List[float], np.ndarray],
+                voltage_ref: float,
+                resolution: int,
+                bipolar: bool = False) -> np.ndarray:
+    """Scale analog values to steps of the converter, before rounding.
+
+    :param array: Floating values to be converted
+    :type array: Union[List[float], np.ndarray]
+    :param voltage_ref: Reference for quantization
+    :type voltage_ref: float
+    :param resolution: Resolution for quantization
+    :type resolution: int
+    :param bipolar: Type of quantization
+    :type bipolar: bool
+    :return: Values in steps of the converter
+    :rtype: np.ndarray
+    """
+
+    array = np.asarray(array)
+
+    # Work in the precision numpy uses for a single element of the array,
+    # so results do not depend on scalar/array promotion rules
+    zero = array.dtype.type(0)
+    max_values = 2**resolution
+    if bipolar:
+        step = float(2 * voltage_ref / max_values)
+        dtype = ((zero + voltage_ref) / step).dtype
+        scaled = (array.astype(dtype, copy=False) + voltage_ref) / step
+    else:
+        step = float(voltage_ref / max_values)
+        dtype = (zero / step).dtype
+        scaled = array.astype(dtype, copy=False) / step
+
+    return scaled
+
+
+def quantize_resolutions(array: Union[List[float], np.ndarray],
+                         voltage_ref: float,
+                         resolutions: Iterable[int],
+                         bipolar: bool = False,
+                         operator: Callable[[float], int] = int) -> Dict[
+                             int, np.ndarray]:
+    """Quantize an array for several resolutions with a single conversion.
+
+    Values are scaled once for the highest resolution. Steps of a lower
+    resolution are that step times a power of two, so its scaled values are
+    obtained with an exact multiplication and codes are the same as calling
+    quantize_array for each resolution.
+
+    :param array: Floating values to be converted
+    :type array: Union[List[float], np.ndarray]
+    :param voltage_ref: Reference for quantization
+    :type voltage_ref: float
+    :param resolutions: Resolutions for quantization
+    :type resolutions: Iterable[int]
+    :param bipolar: Type of quantization
+    :type bipolar: bool
+    :param operator: Scalar operator, mapped to its ufunc equivalent
+    :type operator: Callable[[float], int]
+    :return: Numeric values for each resolution
+    :rtype: Dict[int, np.ndarray]
+    """
+
+    resolutions = list(resolutions)
+    if len(resolutions) == 0:
+        return {}
+
+    ufunc = get_ufunc_operator(operator)
+    highest = max(resolutions)
+    scaled = scale_array(array, voltage_ref=voltage_ref,
+                         resolution=highest, bipolar=bipolar)
+
+    codes = {}
+    for resolution in resolutions:
+        factor = scaled.dtype.type(2.0**(resolution - highest))
+        codes[resolution] = ufunc(scaled * factor).astype(np.int64)
+
+    return codes
+
+
 if __name__ == "__main__":
 
     import matplotlib.pylab as plt
@@ -0,0 +1,518 @@
+#!/bin/python3
+import numpy as np
+from math import comb
+from typing import Iterator
+
+from eapprocessor.hwsimulator.adc import quantize_array
+
+MODE_DELTA_SIGMA = "delta-sigma"
+MODE_DELTA = "delta"
+# Outputs of the modulator, cycles times rows, kept at once to sum them for
+# the integrators of the sinc filter
+MODULATOR_BLOCK = 2**21
+
+
+class DeltaSigmaConverter:
+    """Stateful delta-sigma or delta modulation converter.
+
+    Each sample of the recordings is held during osr cycles of the modulator
+    (zero order hold). The output stream is decimated with a sinc (CIC)
+    filter computed in integer arithmetic and the decimated value is
+    quantized with the given resolution, so codes have the same format as
+    the SAR model.
+
+    The delta-sigma modulator has a noise transfer function (1 - z^-1)^order
+    implemented with error feedback and a uniform quantizer of the given
+    levels. High orders need more than 2 levels to be stable. The delta
+    modulator tracks the input with a level that moves one delta_step per
+    cycle, and its output is that level.
+
+    The delta-sigma modulator is a loop over cycles, which is run at once
+    for all channels. The delta modulator and the integrators of the sinc
+    filter are only run sample by sample, from tables of the cycles of a
+    sample. State is carried across chunks, so by default converted values
+    are the same, bit by bit, whatever the chunk size. Giving a
+    segment_length also runs segments of that many samples of each chunk
+    at once: every segment but the first one of a chunk starts from a
+    modulator state obtained running the warmup samples before it, so
+    results are equivalent, but not bit-identical, to a single run, and
+    they change with the chunk size.
+
+    :param n_channels: number of channels of the chunks
+    :type n_channels: int
+    :param voltage_ref: reference for converter, input range is bipolar
+    :type voltage_ref: float
+    :param resolution: resolution of the decimated values
+    :type resolution: int
+    :param order: order of the delta-sigma modulator
+    :type order: int
+    :param osr: oversampling ratio
+    :type osr: int
+    :param levels: levels of the delta-sigma quantizer
+    :type levels: int
+    :param decimation_order: order of the sinc filter, order + 1 by default
+    :type decimation_order: int
+    :param mode: MODE_DELTA_SIGMA or MODE_DELTA
+    :type mode: str
+    :param delta_step: step of the delta modulator, by default the step of
+        a converter with the given resolution
+    :type delta_step: float
+    :param segment_length: samples of each segment run in parallel, None
+        for an exact sequential run
+    :type segment_length: int
+    :param warmup: samples run before each segment to set its state
+    :type warmup: int
+    """
+
+    def __init__(self,
+                 n_channels: int,
+                 voltage_ref: float,
+                 resolution: int,
+                 order: int = 1,
+                 osr: int = 64,
+                 levels: int = 2,
+                 decimation_order: int = None,
+                 mode: str = MODE_DELTA_SIGMA,
+                 delta_step: float = None,
+                 segment_length: int = None,
+                 warmup: int = 16):
+
+        if mode not in (MODE_DELTA_SIGMA, MODE_DELTA):
+            raise AttributeError(f"Unknown mode {mode}")
+        if levels < 2:
+            raise AttributeError("Quantizer needs at least 2 levels")
+
+        self.n_channels = n_channels
+        self.voltage_ref = voltage_ref
+        self.resolution = resolution
+        self.order = order
+        self.osr = osr
+        self.levels = levels
+        self.mode = mode
+        if decimation_order is None:
+            decimation_order = order + 1
+        self.decimation_order = decimation_order
+        if delta_step is None:
+            delta_step = 2 * voltage_ref / 2**resolution
+        self.delta_step = delta_step
+        self.segment_length = segment_length
+        self.warmup = max(warmup, decimation_order)
+        if segment_length is not None and segment_length < self.warmup:
+            raise AttributeError("Segments must be longer than warmup")
+
+        # Error feedback coefficients of (1 - z^-1)^order, without z^0
+        self.coefficients = [(-1)**k * comb(order, k)
+                             for k in range(1, order + 1)]
+        # Steps in units of voltage_ref
+        self.quantizer_step = 2 / (levels - 1)
+        self.level_step = delta_step / voltage_ref
+        # Over a sample, integrator k adds the output of cycle j weighted by
+        # C(osr - 1 - j + k, k) and integrator m <= k by
+        # C(osr - 1 + k - m, k - m)
+        self.integrator_weights = np.array(
+            [[comb(osr - 1 - j + k, k) for k in range(decimation_order)]
+             for j in range(osr)], dtype=np.int64)
+        self.integrator_transition = np.array(
+            [[comb(osr - 1 + k - m, k - m) if m <= k else 0
+              for m in range(decimation_order)]
+             for k in range(decimation_order)], dtype=np.int64)
+        if mode == MODE_DELTA:
+            self.level_table = self._new_level_table()
+            self.level_sums = self.level_table @ self.integrator_weights
+        self.reset()
+
+    def reset(self):
+        """Forget the state, next chunk is taken as start of recording."""
+
+        self.state = self._new_state(self.n_channels)
+        self.history = np.zeros((self.n_channels, self.decimation_order),
+                                dtype=np.int64)
+
+    def _new_state(self, n_rows, initial=None):
+
+        state = {
+            "error": np.zeros((max(self.order, 1), n_rows)),
+            "integrators": np.zeros((self.decimation_order, n_rows),
+                                    dtype=np.int64),
+            "level": np.zeros(n_rows, dtype=np.int64),
+        }
+        if initial is not None and self.mode == MODE_DELTA:
+            state["level"][:] = np.rint(initial / self.level_step)
+        return state
+
+    def _modulate(self, samples: np.ndarray, state: dict) -> np.ndarray:
+        """Run the modulator in lockstep over rows of samples.
+
+        Samples are run in blocks of about MODULATOR_BLOCK cycles of all
+        rows. Over a sample, integrator k of the sinc filter adds the
+        integrators before it and the output of each cycle weighted by
+        binomials, so the integrators are only run sample by sample, from
+        the weighted sums of the outputs of each sample.
+
+        :param samples: samples in units of voltage_ref, shape (rows, samples)
+        :type samples: np.ndarray
+        :param state: modulator state of each row, updated in place
+        :type state: dict
+        :return: last integrator of the sinc filter at the end of each sample
+        :rtype: np.ndarray
+        """
+
+        n_rows, n_samples = samples.shape
+        integrated = np.empty((n_rows, n_samples), dtype=np.int64)
+        block = max(MODULATOR_BLOCK // (self.osr * max(n_rows, 1)), 1)
+        for start in range(0, n_samples, block):
+            block_samples = samples[:, start:start + block]
+            if self.mode == MODE_DELTA_SIGMA:
+                output = self._modulate_delta_sigma(block_samples, state)
+                sums = self._sum_cycles(output)
+            else:
+                sums = self._modulate_delta(block_samples, state)
+            integrated[:, start:start + block] = self._integrate(
+                sums, state["integrators"])
+
+        return integrated
+
+    def _modulate_delta_sigma(self, samples: np.ndarray,
+                              state: dict) -> np.ndarray:
+        """Run the delta-sigma modulator cycle by cycle.
+
+        :return: quantizer index of each cycle, shape (cycles, rows), as
+            booleans with 2 levels
+        :rtype: np.ndarray
+        """
+
+        n_rows, n_samples = samples.shape
+        two_levels = self.levels == 2
+        output = np.empty((n_samples * self.osr, n_rows),
+                          dtype=bool if two_levels else np.float64)
+        # Ring of errors, the most recent last, written over the oldest
+        errors = list(state["error"])
+        value = np.empty(n_rows)
+        scaled = np.empty(n_rows)
+        # value = sample + sum of coefficient * error, in that order
+        terms = [(np.add if coefficient > 0 else np.subtract,
+                  abs(coefficient), len(errors) - k - 1)
+                 for k, coefficient in enumerate(self.coefficients)]
+        step = self.quantizer_step
+        cycle = 0
+        for idx in range(n_samples):
+            sample = samples[:, idx]
+            if len(terms) == 0:
+                value[:] = sample
+            for _ in range(self.osr):
+                previous = sample
+                for operation, magnitude, position in terms:
+                    error = errors[position]
+                    if magnitude != 1:
+                        np.multiply(error, magnitude, out=scaled)
+                        error = scaled
+                    operation(previous, error, out=value)
+                    previous = value
+
+                current = errors.pop(0)
+                if two_levels:
+                    # Same as rounding (value + 1) / 2 and clipping to [0, 1]
+                    np.add(value, 1, out=scaled)
+                    decision = output[cycle]
+                    np.greater(scaled, 1, out=decision)
+                    # Error of quantizer, output minus its input, with the
+                    # output 2 * index - 1 exact
+                    np.multiply(decision, 2.0, out=current)
+                    current -= 1
+                    current -= value
+                else:
+                    index = output[cycle]
+                    np.add(value, 1, out=index)
+                    np.divide(index, step, out=index)
+                    np.rint(index, out=index)
+                    np.clip(index, 0, self.levels - 1, out=index)
+                    np.multiply(index, step, out=current)
+                    current -= 1
+                    current -= value
+                errors.append(current)
+                cycle += 1
+
+        state["error"] = np.array(errors)
+        return output
+
+    def _modulate_delta(self, samples: np.ndarray,
+                        state: dict) -> np.ndarray:
+        """Run the delta modulator for all cycles of each sample at once.
+
+        Each cycle the level moves up when the sample is at or above it, so
+        with a held sample it moves straight to the highest level h + 1
+        whose previous level h is not above the sample, and then alternates
+        between h + 1 and h. Levels relative to h only depend on the
+        starting level relative to h, so the levels of the sample and their
+        weighted sums are taken from a table.
+
+        :return: weighted sums of the levels of each sample, shape (samples,
+            decimation_order, rows)
+        :rtype: np.ndarray
+        """
+
+        step = self.level_step
+        highest = np.floor(samples / step).astype(np.int64)
+        # Correct rounding of the division, as levels are compared to the
+        # sample with the product level * step
+        for _ in range(2):
+            highest += (highest + 1) * step <= samples
+            highest -= highest * step > samples
+        limit = self.osr + 1
+
+        # Level at the start of each sample, from the end of the previous one
+        starts = np.empty(samples.shape, dtype=np.int64)
+        level = state["level"]
+        for idx in range(samples.shape[1]):
+            starts[:, idx] = level
+            offset = level - highest[:, idx]
+            clipped = np.clip(offset, -limit, limit)
+            level = highest[:, idx] + (offset - clipped) + \
+                self.level_table[clipped + limit, -1]
+        state["level"][:] = level
+
+        # Levels of a sample are the ones of the table plus a base level
+        offset = (starts - highest).T
+        clipped = np.clip(offset, -limit, limit)
+        base = highest.T + offset - clipped
+        sums = self.level_sums[clipped + limit].transpose(0, 2, 1)
+        sums += base[:, None, :] * \
+            self.integrator_weights.sum(axis=0).reshape(-1, 1)
+        return sums
+
+    def _new_level_table(self) -> np.ndarray:
+        """Get delta levels relative to h of each cycle of a held sample.
+
+        Rows are starting levels from h - osr - 1 to h + osr + 1, further
+        ones only move one level per cycle during the sample, as these.
+        """
+
+        limit = self.osr + 1
+        offset = np.arange(-limit, limit + 1).reshape(-1, 1)
+        cycles = np.arange(1, self.osr + 1)
+        rising = offset <= 0
+        distance = np.where(rising, 1 - offset, offset)
+        alternating = (cycles - distance) % 2
+        return np.where(cycles <= distance,
+                        np.where(rising, offset + cycles, offset - cycles),
+                        np.where(rising, 1 - alternating, alternating))
+
+    def _sum_cycles(self, output: np.ndarray) -> np.ndarray:
+        """Get weighted sums of the outputs of each sample for integrators.
+
+        Sums are computed in floating point, exact while below 2**53.
+
+        :param output: quantizer index of each cycle, shape (cycles, rows)
+        :return: sums with shape (samples, decimation_order, rows)
+        """
+
+        weights = self.integrator_weights.T
+        cycles = output.reshape(-1, self.osr, output.shape[1])
+        if (self.levels - 1) * weights[-1].sum() < 2**53:
+            sums = np.matmul(weights.astype(np.float64), cycles)
+            return np.rint(sums).astype(np.int64)
+        return np.matmul(weights, cycles.astype(np.int64))
+
+    def _integrate(self, sums: np.ndarray,
+                   integrators: np.ndarray) -> np.ndarray:
+        """Run the integrators of the sinc filter sample by sample.
+
+        :param sums: weighted sums of the outputs of each sample, shape
+            (samples, decimation_order, rows)
+        :param integrators: integrators of each row, updated in place
+        :return: last integrator at the end of each sample, shape (rows,
+            samples)
+        """
+
+        integrated = np.empty((sums.shape[2], sums.shape[0]), dtype=np.int64)
+        for idx in range(sums.shape[0]):
+            integrators[:] = self.integrator_transition @ integrators + \
+                sums[idx]
+            integrated[:, idx] = integrators[-1]
+        return integrated
+
+    def _decimate(self, integrated: np.ndarray,
+                  history: np.ndarray) -> np.ndarray:
+        """Apply the combs of the sinc filter at the decimated rate."""
+
+        combined = np.concatenate((history, integrated), axis=1)
+        for _ in range(self.decimation_order):
+            combined = np.diff(combined, axis=1)
+        return combined
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        """Convert the next chunk of the recording.
+
+        :param chunk: array of float values with shape (channels, samples)
+        :type chunk: np.ndarray
+        :return: converted values with shape (channels, samples)
+        :rtype: np.ndarray
+        """
+
+        chunk = np.asarray(chunk, dtype=np.float64) / self.voltage_ref
+        if chunk.shape[0] != self.n_channels:
+            raise AttributeError(f"Chunk has {chunk.shape[0]} channels, "
+                                 f"expected {self.n_channels}")
+
+        n_samples = chunk.shape[1]
+        length = self.segment_length
+        if length is None or n_samples < 2 * length:
+            n_segments = 0
+        else:
+            n_segments = n_samples // length
+
+        decimated = []
+        if n_segments > 0:
+            n_rows = self.n_channels * n_segments
+            segments = chunk[:, :n_segments * length].reshape(n_rows, length)
+
+            # Rows of first segments continue the carried state, other rows
+            # start from warmup samples of the previous segment
+            first = np.arange(0, n_rows, n_segments)
+            others = np.setdiff1d(np.arange(n_rows), first)
+            previous = chunk[:, :(n_segments - 1) * length].reshape(
+                -1, length)[:, -self.warmup:]
+            state = self._new_state(len(others), initial=previous[:, 0])
+            warmed = self._modulate(previous, state)
+
+            rows_state = self._new_state(n_rows)
+            for key, value in rows_state.items():
+                value[..., first] = self.state[key]
+                value[..., others] = state[key]
+            history = np.empty((n_rows, self.decimation_order),
+                               dtype=np.int64)
+            history[first] = self.history
+            history[others] = warmed[:, -self.decimation_order:]
+
+            integrated = self._modulate(segments, rows_state)
+            decimated += [self._decimate(integrated, history).reshape(
+                self.n_channels, n_segments * length)]
+
+            last = first + n_segments - 1
+            self.state = {key: value[..., last].copy()
+                          for key, value in rows_state.items()}
+            self.history = integrated[last, -self.decimation_order:]
+
+        remainder = chunk[:, n_segments * (length or 0):]
+        if remainder.shape[1] > 0:
+            integrated = self._modulate(remainder, self.state)
+            decimated += [self._decimate(integrated, self.history)]
+            self.history = np.concatenate(
+                (self.history, integrated),
+                axis=1)[:, -self.decimation_order:]
+
+        if len(decimated) == 0:
+            return np.zeros((self.n_channels, 0), dtype=np.int64)
+
+        decimated = np.concatenate(decimated, axis=1)
+        gain = float(self.osr)**self.decimation_order
+        if self.mode == MODE_DELTA_SIGMA:
+            estimate = decimated / gain * self.quantizer_step - 1
+        else:
+            estimate = decimated / gain * self.level_step
+
+        return quantize_array(estimate * self.voltage_ref,
+                              voltage_ref=self.voltage_ref,
+                              resolution=self.resolution,
+                              bipolar=True,
+                              operator=round)
+
+    def flush(self) -> np.ndarray:
+        """Finish the recording and reset the converter.
+
+        Decimated values are returned by process as soon as they are
+        computed, so nothing is pending.
+
+        :return: remaining converted values with shape (channels, 0)
+        :rtype: np.ndarray
+        """
+
+        self.reset()
+        return np.zeros((self.n_channels, 0), dtype=np.int64)
+
+
+def convert_deltasigma_chunks(dataset,
+                              voltage_ref: float,
+                              resolution: int,
+                              chunk_size: int = 100000,
+                              **kwargs) -> Iterator[np.ndarray]:
+    """Convert a recording with a delta-sigma converter chunk by chunk.
+
+    Only one chunk of the recording is in memory at a time, so dataset may
+    be an HDF5 dataset of a long recording, e.g. recgen.recordings. Other
+    keyword arguments are passed to DeltaSigmaConverter.
+
+    :param dataset: recordings with shape (samples, channels)
+    :type dataset: Union[np.ndarray, h5py.Dataset]
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution of the decimated values
+    :type resolution: int
+    :param chunk_size: number of samples read per chunk
+    :type chunk_size: int
+    :return: iterator of converted values with shape (channels, samples)
+    :rtype: Iterator[np.ndarray]
+    """
+
+    n_samples, n_channels = dataset.shape
+    converter = DeltaSigmaConverter(n_channels,
+                                    voltage_ref=voltage_ref,
+                                    resolution=resolution,
+                                    **kwargs)
+
+    for start in range(0, n_samples, chunk_size):
+        chunk = dataset[start:start + chunk_size, :]
+        yield converter.process(np.asarray(chunk).T)
+
+    converter.flush()
+
+
+def get_deltasigma_delay(decimation_order: int) -> float:
+    """Get delay of converted values in samples of the recordings.
+
+    Each converted value is taken at the end of the held sample, and the
+    sinc filter is centered decimation_order / 2 samples before it.
+
+    :param decimation_order: order of the sinc filter
+    :type decimation_order: int
+    :return: delay in samples of the recordings
+    :rtype: float
+    """
+
+    return (decimation_order - 1) / 2
+
+
+if __name__ == "__main__":
+
+    import time
+
+    fs = 20e3
+    n_channels = 32
+    n_samples = 20000
+    time_array = np.arange(n_samples) / fs
+    frequencies = np.linspace(100, 1000, n_channels).reshape(-1, 1)
+    recordings = 500 * np.sin(2 * np.pi * frequencies * time_array)
+
+    for mode, order, levels in [(MODE_DELTA_SIGMA, 1, 2),
+                                (MODE_DELTA_SIGMA, 2, 2),
+                                (MODE_DELTA_SIGMA, 3, 9),
+                                (MODE_DELTA, 1, 2)]:
+        # Segments run at once, equivalent but not bit-identical results
+        converter = DeltaSigmaConverter(n_channels, voltage_ref=1000,
+                                        resolution=12, order=order,
+                                        osr=128, levels=levels, mode=mode,
+                                        segment_length=256)
+        start = time.perf_counter()
+        codes = converter.process(recordings)
+        elapsed = time.perf_counter() - start
+
+        delay = get_deltasigma_delay(converter.decimation_order)
+        delayed = np.array([np.interp(time_array - delay / fs, time_array,
+                                      recording)
+                            for recording in recordings])
+        reference = quantize_array(delayed, 1000, 12, bipolar=True,
+                                   operator=round)
+        error = np.abs(codes - reference)[:, 10:]
+        print(f"{mode} order {order}: {elapsed:.2f} s for "
+              f"{n_channels}x{n_samples} at osr 128, "
+              f"median error {np.median(error)} codes")
@@ -0,0 +1,626 @@
+#!/bin/python3
+import itertools
+import numpy as np
+from typing import List, Tuple, Callable, Iterator, Iterable, Dict
+
+from eapprocessor.hwsimulator.adc import quantize, quantize_array, \
+    get_ufunc_operator, get_code_dtype
+from eapprocessor.tools.ragged import RaggedArray
+
+
+def get_lcadc_steps(voltage_ref: float,
+                    resolution: int,
+                    bipolar: bool = False) -> Tuple[float, float, float,
+                                                    float]:
+    """Get the constants used by the LCADC model.
+
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :return: crossing step, step to quantize the difference with the latest
+        reference, step and offset of the dac
+    :rtype: Tuple[float, float, float, float]
+    """
+
+    max_windows = 2**resolution
+    if bipolar:
+        step = float(2 * voltage_ref / max_windows)
+        offset = float(voltage_ref)
+    else:
+        step = float(voltage_ref / max_windows)
+        offset = 0.0
+    step_difference = float(2 * voltage_ref / max_windows)
+
+    return step, step_difference, step, offset
+
+
+def advance_lcadc(samples: np.ndarray,
+                  code: np.ndarray,
+                  reference: np.ndarray,
+                  step: float,
+                  step_difference: float,
+                  dac_step: float,
+                  dac_offset: float,
+                  ufunc: Callable,
+                  hysteresis: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Advance the reference of every channel in lockstep over samples.
+
+    The state of the converter (code and reference) is updated in place, so
+    consecutive calls continue where the previous one finished. A crossing
+    is detected when a sample is at least step + hysteresis away from the
+    latest reference. Step parameters may be scalars or arrays with a value
+    per channel.
+
+    :param samples: samples with shape (samples, channels)
+    :type samples: np.ndarray
+    :param code: latest code per channel, updated in place
+    :type code: np.ndarray
+    :param reference: latest dac value per channel, updated in place
+    :type reference: np.ndarray
+    :param step: step to detect a level crossing
+    :type step: float
+    :param step_difference: step to quantize the difference with reference
+    :type step_difference: float
+    :param dac_step: step of the dac
+    :type dac_step: float
+    :param dac_offset: offset of the dac
+    :type dac_offset: float
+    :param ufunc: element-wise rounding operator
+    :type ufunc: Callable
+    :param hysteresis: band added to the crossing step around the reference
+    :type hysteresis: float
+    :return: mask of crossings and codes with shape (samples, channels),
+        codes are only meaningful where there is a crossing
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+
+    n_samples, n_channels = samples.shape
+    crossings = np.zeros((n_samples, n_channels), dtype=bool)
+    codes = np.zeros((n_samples, n_channels), dtype=np.int64)
+
+    # Codes are kept as exact integers in floating point to avoid casts
+    float_code = code.astype(np.float64)
+    work_reference = reference.astype(samples.dtype)
+    difference = np.empty(n_channels, dtype=samples.dtype)
+    absolute = np.empty(n_channels, dtype=samples.dtype)
+    threshold = step + hysteresis
+
+    for idx in range(n_samples):
+        hit = crossings[idx]
+        np.subtract(samples[idx], work_reference, out=difference)
+        np.absolute(difference, out=absolute)
+        np.greater_equal(absolute, threshold, out=hit)
+        if not hit.any():
+            continue
+
+        np.divide(difference, step_difference, out=difference)
+        np.add(float_code, ufunc(difference), out=float_code, where=hit,
+               casting='unsafe')
+        np.multiply(float_code, dac_step, out=reference)
+        np.subtract(reference, dac_offset, out=reference)
+        np.copyto(work_reference, reference, casting='unsafe')
+        codes[idx] = float_code
+
+    code[:] = float_code
+    return crossings, codes
+
+
+class LCADCConverter:
+    """Stateful LCADC converter for chunked processing.
+
+    The latest code and reference of every channel are carried across
+    chunks, so converting a recording chunk by chunk gives the same indexes
+    and codes as converting it at once. Indexes are global, i.e. counted from
+    the first sample given to the converter.
+
+    :param n_channels: number of channels of the chunks
+    :type n_channels: int
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param operator: scalar rounding operator as used by quantize
+    :type operator: Callable[[float], int]
+    :param hysteresis: band added to the crossing step around the latest
+        reference, in units of the recordings
+    :type hysteresis: float
+    """
+
+    def __init__(self,
+                 n_channels: int,
+                 voltage_ref: float,
+                 resolution: int,
+                 bipolar: bool = False,
+                 operator: Callable[[float], int] = int,
+                 hysteresis: float = 0):
+
+        self.n_channels = n_channels
+        self.voltage_ref = voltage_ref
+        self.resolution = resolution
+        self.bipolar = bipolar
+        self.operator = operator
+        self.hysteresis = hysteresis
+        self.ufunc = get_ufunc_operator(operator)
+        self.step, self.step_difference, self.dac_step, self.dac_offset = \
+            get_lcadc_steps(voltage_ref, resolution, bipolar)
+        self.reset()
+
+    def reset(self):
+        """Forget the state, next chunk is taken as start of recording."""
+
+        self.position = 0
+        self.code = None
+        self.reference = None
+
+    def process(self, chunk: np.ndarray) -> Tuple[List[np.ndarray],
+                                                  List[np.ndarray]]:
+        """Convert the next chunk of the recording.
+
+        :param chunk: array of float values with shape (channels, samples)
+        :type chunk: np.ndarray
+        :return: global indexes and converted values per channel
+        :rtype: Tuple[List[np.ndarray], List[np.ndarray]]
+        """
+
+        chunk = np.asarray(chunk)
+        if chunk.shape[0] != self.n_channels:
+            raise AttributeError(f"Chunk has {chunk.shape[0]} channels, "
+                                 f"expected {self.n_channels}")
+
+        n_samples = chunk.shape[1]
+        first_indexes = [np.array([], dtype=np.int64)] * self.n_channels
+        first_codes = [np.array([], dtype=np.int64)] * self.n_channels
+        if n_samples == 0:
+            return first_indexes, first_codes
+
+        start = 0
+        if self.code is None:
+            # First sample of each channel is always converted against 0
+            self.code = np.array([quantize(item - 0,
+                                           voltage_ref=self.voltage_ref,
+                                           resolution=self.resolution,
+                                           bipolar=self.bipolar,
+                                           operator=self.operator)
+                                  for item in chunk[:, 0]], dtype=np.int64)
+            self.reference = self.code * self.dac_step - self.dac_offset
+            first_indexes = [np.array([self.position], dtype=np.int64)] * \
+                self.n_channels
+            first_codes = [np.array([code]) for code in self.code]
+            start = 1
+
+        # Same precision as a single element minus the float reference
+        dtype = (chunk.dtype.type(0) - 0.0).dtype
+        samples = np.ascontiguousarray(chunk[:, start:].T, dtype=dtype)
+
+        crossings, codes = advance_lcadc(samples, self.code, self.reference,
+                                         step=self.step,
+                                         step_difference=self.step_difference,
+                                         dac_step=self.dac_step,
+                                         dac_offset=self.dac_offset,
+                                         ufunc=self.ufunc,
+                                         hysteresis=self.hysteresis)
+
+        offset = self.position + start
+        indexes = []
+        converted = []
+        for channel in range(self.n_channels):
+            channel_indexes = np.flatnonzero(crossings[:, channel])
+            indexes += [np.concatenate((first_indexes[channel],
+                                        channel_indexes + offset))]
+            converted += [np.concatenate((first_codes[channel],
+                                          codes[channel_indexes, channel]))]
+
+        self.position += n_samples
+        return indexes, converted
+
+    def flush(self) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """Finish the recording and reset the converter.
+
+        The LCADC model has no look-ahead, so every event was already
+        returned by process and nothing is pending.
+
+        :return: remaining global indexes and converted values per channel
+        :rtype: Tuple[List[np.ndarray], List[np.ndarray]]
+        """
+
+        self.reset()
+        return ([np.array([], dtype=np.int64)] * self.n_channels,
+                [np.array([], dtype=np.int64)] * self.n_channels)
+
+
+def convert_lcadc_matrix(matrix: np.ndarray,
+                         voltage_ref: float,
+                         resolution: int,
+                         bipolar: bool = False,
+                         operator: Callable[[float], int] = int) -> Tuple[
+                             List[np.ndarray], List[np.ndarray]]:
+    """Convert all channels with LCADC model at once.
+
+    Every channel's reference is advanced in lockstep, so the Python loop
+    runs once per sample instead of once per sample and channel. Indexes and
+    codes are the same as applying convert_lcadc to every channel.
+
+    :param matrix: array of float values with shape (channels, samples)
+    :type matrix: np.ndarray
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :return: indexes and converted values per channel
+    :rtype: Tuple[List[np.ndarray], List[np.ndarray]]
+    """
+
+    matrix = np.asarray(matrix)
+    converter = LCADCConverter(matrix.shape[0],
+                               voltage_ref=voltage_ref,
+                               resolution=resolution,
+                               bipolar=bipolar,
+                               operator=operator)
+    return converter.process(matrix)
+
+
+def convert_lcadc_chunks(dataset,
+                         voltage_ref: float,
+                         resolution: int,
+                         bipolar: bool = False,
+                         operator: Callable[[float], int] = int,
+                         chunk_size: int = 100000) -> Iterator[Tuple[
+                             List[np.ndarray], List[np.ndarray]]]:
+    """Convert a recording with LCADC model reading it chunk by chunk.
+
+    Only one chunk of the recording is in memory at a time, so dataset may
+    be an HDF5 dataset of a long recording, e.g. recgen.recordings.
+
+    :param dataset: recordings with shape (samples, channels)
+    :type dataset: Union[np.ndarray, h5py.Dataset]
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param chunk_size: number of samples read per chunk
+    :type chunk_size: int
+    :return: iterator of global indexes and converted values per channel
+    :rtype: Iterator[Tuple[List[np.ndarray], List[np.ndarray]]]
+    """
+
+    n_samples, n_channels = dataset.shape
+    converter = LCADCConverter(n_channels,
+                               voltage_ref=voltage_ref,
+                               resolution=resolution,
+                               bipolar=bipolar,
+                               operator=operator)
+
+    for start in range(0, n_samples, chunk_size):
+        chunk = dataset[start:start + chunk_size, :]
+        yield converter.process(np.asarray(chunk).T)
+
+    converter.flush()
+
+
+def estimate_lcadc_rates(matrix: np.ndarray,
+                         fs: float,
+                         voltage_ref: float,
+                         resolutions: Iterable[int],
+                         bipolar: bool = False,
+                         operator: Callable[[float], int] = int,
+                         window_time: float = 0.01,
+                         fraction: float = 1.0,
+                         bits_per_event: int = None,
+                         seed: int = None) -> Dict[str, np.ndarray]:
+    """Estimate LCADC event rates for several resolutions at once.
+
+    Crossings are counted for every resolution and channel in lockstep,
+    window by window, without keeping indexes nor codes. With fraction 1
+    every window is processed carrying the state, so counts are the ones
+    of convert_lcadc. With a lower fraction only that part of the windows,
+    chosen at random, is processed; each of them starts converting its
+    first sample as convert_lcadc does, and that sample is not counted.
+
+    :param matrix: array of float values with shape (channels, samples)
+    :type matrix: np.ndarray
+    :param fs: sampling frequency
+    :type fs: float
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolutions: resolutions for converter
+    :type resolutions: Iterable[int]
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param window_time: duration of windows for the peak rate in seconds
+    :type window_time: float
+    :param fraction: fraction of windows processed
+    :type fraction: float
+    :param bits_per_event: bits sent per event, resolution by default
+    :type bits_per_event: int
+    :param seed: seed to choose windows
+    :type seed: int
+    :return: dictionary with resolutions, counts_sampled of events in the
+        processed windows only, mean and peak rates in events per second
+        and bit rate in bits per second, each of them with shape
+        (resolutions, channels)
+    :rtype: Dict[str, np.ndarray]
+    """
+
+    matrix = np.asarray(matrix)
+    resolutions = np.array(list(resolutions))
+    n_channels, n_samples = matrix.shape
+    n_resolutions = len(resolutions)
+    window = max(int(round(window_time * fs)), 1)
+    n_windows = int(np.ceil(n_samples / window))
+
+    # Rows are (resolution, channel) pairs, with parameters of each row
+    steps = np.array([get_lcadc_steps(voltage_ref, resolution, bipolar)
+                      for resolution in resolutions])
+    row_steps = [np.repeat(column, n_channels) for column in steps.T]
+    step, step_difference, dac_step, dac_offset = row_steps
+    ufunc = get_ufunc_operator(operator)
+
+    if fraction >= 1:
+        selected = np.arange(n_windows)
+    else:
+        rng = np.random.default_rng(seed)
+        n_selected = max(int(round(fraction * n_windows)), 1)
+        selected = np.sort(rng.choice(n_windows, n_selected, replace=False))
+
+    dtype = (matrix.dtype.type(0) - 0.0).dtype
+    counts = np.zeros((len(selected), n_resolutions * n_channels),
+                      dtype=np.int64)
+    durations = np.zeros(len(selected))
+    code = None
+    reference = None
+    previous = None
+    for idx, window_idx in enumerate(selected):
+        start = window_idx * window
+        samples = np.asarray(matrix[:, start:start + window], dtype=dtype)
+        durations[idx] = samples.shape[1] / fs
+        if previous is None or window_idx != previous + 1:
+            # Start as convert_lcadc, converting first sample against 0
+            code = np.concatenate([
+                quantize_array(samples[:, 0],
+                               voltage_ref=voltage_ref,
+                               resolution=resolution,
+                               bipolar=bipolar,
+                               operator=operator)
+                for resolution in resolutions])
+            reference = code * dac_step - dac_offset
+            if start == 0:
+                counts[idx] += 1
+            samples = samples[:, 1:]
+        previous = window_idx
+
+        rows = np.tile(samples.T, (1, n_resolutions))
+        crossings, _ = advance_lcadc(rows, code, reference,
+                                     step=step,
+                                     step_difference=step_difference,
+                                     dac_step=dac_step,
+                                     dac_offset=dac_offset,
+                                     ufunc=ufunc)
+        counts[idx] += crossings.sum(axis=0)
+
+    shape = (n_resolutions, n_channels)
+    rates = counts / durations.reshape(-1, 1)
+    mean_rate = (counts.sum(axis=0) / durations.sum()).reshape(shape)
+    peak_rate = rates.max(axis=0).reshape(shape)
+
+    if bits_per_event is None:
+        bits_per_event = resolutions.reshape(-1, 1)
+
+    return {
+        "resolutions": resolutions,
+        # Counts of the processed windows, not of the whole recording
+        "counts_sampled": counts.sum(axis=0).reshape(shape),
+        "mean_rate": mean_rate,
+        "peak_rate": peak_rate,
+        "bit_rate": mean_rate * bits_per_event,
+    }
+
+
+def sweep_lcadc(dataset,
+                voltage_refs: Iterable[float],
+                resolutions: Iterable[int],
+                hystereses: Iterable[float] = (0,),
+                bipolar: bool = False,
+                operator: Callable[[float], int] = int,
+                chunk_size: int = 100000) -> Dict[str, np.ndarray]:
+    """Convert a recording with many LCADC configurations in one pass.
+
+    Every combination of voltage reference, resolution and hysteresis is a
+    configuration. Rows (configuration, channel) are advanced in lockstep
+    over chunks of the recording, so it is read once for all of them. Each
+    row gives the same indexes and codes as LCADCConverter with the same
+    parameters.
+
+    :param dataset: recordings with shape (samples, channels)
+    :type dataset: Union[np.ndarray, h5py.Dataset]
+    :param voltage_refs: references for converter
+    :type voltage_refs: Iterable[float]
+    :param resolutions: resolutions for converter
+    :type resolutions: Iterable[int]
+    :param hystereses: bands added to the crossing step around the latest
+        reference, in units of the recordings
+    :type hystereses: Iterable[float]
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param chunk_size: number of samples read per chunk
+    :type chunk_size: int
+    :return: dictionary with voltage_ref, resolution and hysteresis of each
+        configuration, channels, counts with shape (configurations,
+        channels), and indexes and lcadc values as ragged arrays of
+        configurations * channels rows, row k * channels + c being channel c
+        of configuration k
+    :rtype: Dict[str, np.ndarray]
+    """
+
+    configurations = np.array(list(itertools.product(voltage_refs,
+                                                     resolutions,
+                                                     hystereses)),
+                              dtype=np.float64).reshape(-1, 3)
+    voltage_ref = configurations[:, 0]
+    resolution = configurations[:, 1].astype(int)
+    hysteresis = configurations[:, 2]
+    n_samples, n_channels = dataset.shape
+    n_configurations = len(configurations)
+
+    steps = np.array([get_lcadc_steps(vref, res, bipolar)
+                      for vref, res in zip(voltage_ref, resolution)])
+    step, step_difference, dac_step, dac_offset = \
+        [np.repeat(column, n_channels) for column in steps.reshape(-1, 4).T]
+    row_hysteresis = np.repeat(hysteresis, n_channels)
+    ufunc = get_ufunc_operator(operator)
+
+    code = None
+    reference = None
+    rows = []
+    indexes = []
+    codes = []
+    for start in range(0, n_samples, chunk_size):
+        chunk = np.asarray(dataset[start:start + chunk_size, :])
+        offset = start
+        if code is None:
+            # First sample of each row is always converted against 0
+            code = np.concatenate([
+                quantize_array(chunk[0], voltage_ref=vref, resolution=res,
+                               bipolar=bipolar, operator=operator)
+                for vref, res in zip(voltage_ref, resolution)]
+                + [np.zeros(0, dtype=np.int64)])
+            reference = code * dac_step - dac_offset
+            rows += [np.arange(len(code))]
+            indexes += [np.zeros(len(code), dtype=np.int64)]
+            codes += [code.copy()]
+            chunk = chunk[1:]
+            offset += 1
+
+        # Same precision as a single element minus the float reference,
+        # scalar parameters of the converter are taken with that precision
+        dtype = (chunk.dtype.type(0) - 0.0).dtype
+        samples = np.tile(np.asarray(chunk, dtype=dtype),
+                          (1, n_configurations))
+        crossings, chunk_codes = advance_lcadc(
+            samples, code, reference,
+            step=step.astype(dtype),
+            step_difference=step_difference.astype(dtype),
+            dac_step=dac_step,
+            dac_offset=dac_offset,
+            ufunc=ufunc,
+            hysteresis=row_hysteresis.astype(dtype))
+
+        # Events sorted by row and then by sample
+        chunk_rows, chunk_samples = np.nonzero(crossings.T)
+        rows += [chunk_rows]
+        indexes += [chunk_samples + offset]
+        codes += [chunk_codes[chunk_samples, chunk_rows]]
+
+    n_rows = n_configurations * n_channels
+    rows = np.concatenate([np.zeros(0, dtype=np.int64)] + rows)
+    order = np.argsort(rows, kind='stable')
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=offsets[1:])
+
+    codes = np.concatenate([np.zeros(0, dtype=np.int64)] + codes)[order]
+    code_dtype = get_code_dtype(
+        int(resolution.max(initial=1)),
+        low=min(0, int(codes.min(initial=0))),
+        high=max(0, int(codes.max(initial=0))))
+
+    return {
+        "voltage_ref": voltage_ref,
+        "resolution": resolution,
+        "hysteresis": hysteresis,
+        "channels": np.arange(n_channels),
+        "counts": np.diff(offsets).reshape(n_configurations, n_channels),
+        "indexes": RaggedArray(np.concatenate(
+            [np.zeros(0, dtype=np.int64)] + indexes)[order], offsets),
+        "lcadc": RaggedArray(codes.astype(code_dtype), offsets),
+    }
+
+
+def get_sweep_configuration(sweep: Dict[str, np.ndarray],
+                            configuration: int) -> Tuple[RaggedArray,
+                                                         RaggedArray]:
+    """Get indexes and lcadc values of a configuration of a sweep.
+
+    :param sweep: result of sweep_lcadc
+    :type sweep: Dict[str, np.ndarray]
+    :param configuration: index of the configuration
+    :type configuration: int
+    :return: indexes and lcadc values per channel, views of the sweep
+    :rtype: Tuple[RaggedArray, RaggedArray]
+    """
+
+    n_channels = len(sweep["channels"])
+    rows = slice(configuration * n_channels,
+                 (configuration + 1) * n_channels)
+    return sweep["indexes"][rows], sweep["lcadc"][rows]
+
+
+if __name__ == "__main__":
+
+    import time
+    from eapprocessor.hwsimulator.adc import convert_lcadc
+
+    # Benchmark against converting channel by channel with convert_lcadc
+    n_channels = 32
+    n_samples = 20000
+    resolution = 12
+    rng = np.random.default_rng(0)
+    recordings = (rng.standard_normal((n_channels, n_samples)) * 20
+                  ).astype(np.float32)
+
+    start = time.perf_counter()
+    reference = [convert_lcadc(array, voltage_ref=1000,
+                               resolution=resolution,
+                               bipolar=True,
+                               operator=round) for array in recordings]
+    time_channels = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexes, converted = convert_lcadc_matrix(recordings, voltage_ref=1000,
+                                              resolution=resolution,
+                                              bipolar=True,
+                                              operator=round)
+    time_matrix = time.perf_counter() - start
+
+    equal = all(np.array_equal(ref_indexes, indexes[idx]) and
+                np.array_equal(ref_converted, converted[idx])
+                for idx, (ref_indexes, ref_converted) in enumerate(reference))
+
+    print(f"Channels: {n_channels}, samples: {n_samples}")
+    print(f"convert_lcadc per channel: {time_channels:.3f} s")
+    print(f"convert_lcadc_matrix: {time_matrix:.3f} s")
+    print(f"Speedup: {time_channels / time_matrix:.1f}x, equal: {equal}")
+
+    resolutions = [6, 8, 10, 12]
+    start = time.perf_counter()
+    rates = estimate_lcadc_rates(recordings, fs=20e3, voltage_ref=1000,
+                                 resolutions=resolutions, bipolar=True,
+                                 operator=round, fraction=0.1, seed=0)
+    time_rates = time.perf_counter() - start
+    print(f"Rates for resolutions {resolutions} from 10% of windows: "
+          f"{time_rates:.3f} s")
+    for idx, resolution in enumerate(resolutions):
+        print(f"{resolution} bits: "
+              f"{rates['mean_rate'][idx].mean():.0f} events/s, "
+              f"{rates['bit_rate'][idx].mean() / 1e3:.1f} kbit/s")
+
+    hystereses = [0, 2 * 1000 / 2**resolution]
+    start = time.perf_counter()
+    sweep = sweep_lcadc(recordings.T, voltage_refs=[500, 1000],
+                        resolutions=resolutions, hystereses=hystereses,
+                        bipolar=True, operator=round, chunk_size=5000)
+    time_sweep = time.perf_counter() - start
+    print(f"Sweep of {len(sweep['resolution'])} configurations: "
+          f"{time_sweep:.3f} s")
+    for idx, counts in enumerate(sweep["counts"]):
+        print(f"vref {sweep['voltage_ref'][idx]:.0f}, "
+              f"{sweep['resolution'][idx]} bits, "
+              f"hysteresis {sweep['hysteresis'][idx]:.2f}: "
+              f"{counts.mean():.0f} events per channel")
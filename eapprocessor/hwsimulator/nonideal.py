@@ -0,0 +1,291 @@
+#!/bin/python3
+import numpy as np
+from typing import Union, List, Tuple
+
+from eapprocessor.hwsimulator.adc import compact_codes
+
+
+def get_rng(seed: Union[int, np.random.Generator] = None
+            ) -> np.random.Generator:
+    """Get a random generator from a seed or an existing generator.
+
+    :param seed: seed or generator, None for a fresh generator
+    :type seed: Union[int, np.random.Generator]
+    :return: random generator
+    :rtype: np.random.Generator
+    """
+
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def sample_channel_errors(n_channels: int,
+                          offset_std: float = 0,
+                          gain_std: float = 0,
+                          seed: Union[int, np.random.Generator] = None
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample offset and gain error for each channel.
+
+    :param n_channels: number of channels
+    :type n_channels: int
+    :param offset_std: standard deviation of offset, in units of recordings
+    :type offset_std: float
+    :param gain_std: standard deviation of relative gain error
+    :type gain_std: float
+    :param seed: seed or generator for the random values
+    :type seed: Union[int, np.random.Generator]
+    :return: offset and gain per channel
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+
+    rng = get_rng(seed)
+    offset = rng.normal(0, offset_std, n_channels)
+    gain = 1 + rng.normal(0, gain_std, n_channels)
+    return offset, gain
+
+
+def generate_dnl(resolution: int,
+                 dnl_std: float,
+                 seed: Union[int, np.random.Generator] = None) -> np.ndarray:
+    """Generate a random differential non-linearity for each code.
+
+    The first and last codes are not bounded, so their DNL is zero. DNL of
+    the inner codes has zero mean, keeping the endpoints of the transfer
+    curve, and is limited to -1 (missing code); what clipping adds is
+    subtracted from the codes that are not missing.
+
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param dnl_std: standard deviation of DNL, in LSB
+    :type dnl_std: float
+    :param seed: seed or generator for the random values
+    :type seed: Union[int, np.random.Generator]
+    :return: DNL in LSB with length 2**resolution
+    :rtype: np.ndarray
+    """
+
+    rng = get_rng(seed)
+    dnl = np.zeros(2**resolution)
+    if len(dnl) > 2:
+        inner = rng.normal(0, dnl_std, len(dnl) - 2)
+        inner = np.maximum(inner - inner.mean(), -1)
+        # Excess of clipped codes is taken from the others until none is left
+        excess = inner.sum()
+        tolerance = np.finfo(np.float64).eps * len(inner)
+        while excess > tolerance:
+            free = inner > -1
+            inner[free] -= excess / np.count_nonzero(free)
+            inner = np.maximum(inner, -1)
+            excess = inner.sum()
+        dnl[1:-1] = inner
+    return dnl
+
+
+def get_transition_levels(voltage_ref: float,
+                          resolution: int,
+                          bipolar: bool = False,
+                          dnl: Union[List[float], np.ndarray] = None
+                          ) -> np.ndarray:
+    """Get input levels where the output code changes.
+
+    Level k - 1 is the lowest input converted to code k. Without DNL they are
+    the ones of the ideal converter that floors values, i.e. the model of
+    quantize with operator=int for inputs in range.
+
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param dnl: DNL in LSB for each code, as given by generate_dnl
+    :type dnl: Union[List[float], np.ndarray]
+    :return: transition levels with length 2**resolution - 1
+    :rtype: np.ndarray
+    """
+
+    max_values = 2**resolution
+    if bipolar:
+        step = float(2 * voltage_ref / max_values)
+        lowest = -float(voltage_ref)
+    else:
+        step = float(voltage_ref / max_values)
+        lowest = 0.0
+
+    widths = np.ones(max_values - 1)
+    if dnl is not None:
+        widths[1:] += np.asarray(dnl, dtype=np.float64)[1:-1]
+
+    return lowest + step * np.cumsum(widths)
+
+
+def get_inl(dnl: Union[List[float], np.ndarray]) -> np.ndarray:
+    """Get integral non-linearity from the DNL of each code.
+
+    :param dnl: DNL in LSB for each code
+    :type dnl: Union[List[float], np.ndarray]
+    :return: INL in LSB for each code
+    :rtype: np.ndarray
+    """
+
+    return np.cumsum(dnl)
+
+
+def apply_nonidealities(matrix: np.ndarray,
+                        offset: Union[float, np.ndarray] = 0,
+                        gain: Union[float, np.ndarray] = 1,
+                        noise_std: float = 0,
+                        jitter_std: float = 0,
+                        fs: float = None,
+                        seed: Union[int, np.random.Generator] = None,
+                        dtype: type = np.float32) -> np.ndarray:
+    """Apply analog errors of the converter to recordings.
+
+    Each sample is taken with a random time error (aperture jitter), which
+    is approximated with the slope of the signal. Then gain and offset of
+    each channel are applied and input referred noise is added.
+
+    :param matrix: recordings with shape (channels, samples)
+    :type matrix: np.ndarray
+    :param offset: offset, scalar or per channel
+    :type offset: Union[float, np.ndarray]
+    :param gain: gain, scalar or per channel
+    :type gain: Union[float, np.ndarray]
+    :param noise_std: standard deviation of input referred noise
+    :type noise_std: float
+    :param jitter_std: standard deviation of sampling time error in seconds
+    :type jitter_std: float
+    :param fs: sampling frequency, required with jitter
+    :type fs: float
+    :param seed: seed or generator for the random values
+    :type seed: Union[int, np.random.Generator]
+    :param dtype: floating type for the computation
+    :type dtype: type
+    :return: sampled values with shape (channels, samples)
+    :rtype: np.ndarray
+    """
+
+    rng = get_rng(seed)
+    sampled = np.array(matrix, dtype=dtype)
+    if sampled.ndim == 1:
+        sampled = sampled.reshape(1, -1)
+
+    if jitter_std > 0:
+        if fs is None:
+            raise AttributeError("Sampling frequency is required to "
+                                 "apply jitter")
+        slope = np.gradient(sampled, axis=-1)
+        slope *= dtype(fs * jitter_std)
+        slope *= rng.standard_normal(sampled.shape, dtype=dtype)
+        sampled += slope
+        del slope
+
+    gain = np.asarray(gain, dtype=dtype)
+    offset = np.asarray(offset, dtype=dtype)
+    sampled *= gain.reshape(-1, 1) if gain.ndim else gain
+    sampled += offset.reshape(-1, 1) if offset.ndim else offset
+
+    if noise_std > 0:
+        noise = rng.standard_normal(sampled.shape, dtype=dtype)
+        noise *= dtype(noise_std)
+        sampled += noise
+
+    return sampled
+
+
+def convert_nonideal(matrix: np.ndarray,
+                     voltage_ref: float,
+                     resolution: int,
+                     bipolar: bool = False,
+                     offset: Union[float, np.ndarray] = 0,
+                     gain: Union[float, np.ndarray] = 1,
+                     dnl: Union[List[float], np.ndarray] = None,
+                     transition_levels: np.ndarray = None,
+                     noise_std: float = 0,
+                     jitter_std: float = 0,
+                     fs: float = None,
+                     seed: Union[int, np.random.Generator] = None,
+                     dtype: type = np.float32) -> np.ndarray:
+    """Convert recordings with a non ideal converter.
+
+    Analog errors are applied with apply_nonidealities and values are
+    converted looking up the transfer curve, so codes saturate at 0 and
+    2**resolution - 1. A measured transfer curve can be given with
+    transition_levels instead of dnl.
+
+    :param matrix: recordings with shape (channels, samples)
+    :type matrix: np.ndarray
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param offset: offset, scalar or per channel
+    :type offset: Union[float, np.ndarray]
+    :param gain: gain, scalar or per channel
+    :type gain: Union[float, np.ndarray]
+    :param dnl: DNL in LSB for each code, as given by generate_dnl
+    :type dnl: Union[List[float], np.ndarray]
+    :param transition_levels: levels where the code changes, overrides dnl
+    :type transition_levels: np.ndarray
+    :param noise_std: standard deviation of input referred noise
+    :type noise_std: float
+    :param jitter_std: standard deviation of sampling time error in seconds
+    :type jitter_std: float
+    :param fs: sampling frequency, required with jitter
+    :type fs: float
+    :param seed: seed or generator for the random values
+    :type seed: Union[int, np.random.Generator]
+    :param dtype: floating type for the computation
+    :type dtype: type
+    :return: converted values with shape (channels, samples)
+    :rtype: np.ndarray
+    """
+
+    sampled = apply_nonidealities(matrix, offset=offset, gain=gain,
+                                  noise_std=noise_std,
+                                  jitter_std=jitter_std, fs=fs,
+                                  seed=seed, dtype=dtype)
+
+    if transition_levels is None:
+        transition_levels = get_transition_levels(voltage_ref, resolution,
+                                                  bipolar=bipolar, dnl=dnl)
+    transition_levels = np.asarray(transition_levels, dtype=dtype)
+
+    codes = np.searchsorted(transition_levels, sampled, side='right')
+    return compact_codes(codes, resolution)
+
+
+if __name__ == "__main__":
+
+    import time
+    from eapprocessor.hwsimulator.adc import quantize_array
+
+    n_channels = 32
+    n_samples = 200000
+    resolution = 12
+    rng = np.random.default_rng(0)
+    recordings = (rng.standard_normal((n_channels, n_samples)) * 100
+                  ).astype(np.float32)
+
+    ideal = convert_nonideal(recordings, 1000, resolution, bipolar=True,
+                             dtype=np.float64)
+    reference = np.clip(quantize_array(recordings.astype(np.float64), 1000,
+                                       resolution, bipolar=True),
+                        0, 2**resolution - 1)
+    print("Ideal equal to quantize:", np.array_equal(ideal, reference))
+
+    offset, gain = sample_channel_errors(n_channels, offset_std=5,
+                                         gain_std=0.01, seed=1)
+    dnl = generate_dnl(resolution, dnl_std=0.2, seed=1)
+
+    start = time.perf_counter()
+    codes = convert_nonideal(recordings, 1000, resolution, bipolar=True,
+                             offset=offset, gain=gain, dnl=dnl,
+                             noise_std=2, jitter_std=1e-6, fs=20e3, seed=1)
+    elapsed = time.perf_counter() - start
+    print(f"Non ideal conversion of {n_channels}x{n_samples}: "
+          f"{elapsed:.3f} s")
+    print("Max INL:", np.max(np.abs(get_inl(dnl))))
@@ -0,0 +1,164 @@
+#!/bin/python3
+import numpy as np
+from typing import Union
+
+from eapprocessor.hwsimulator.adc import get_code_dtype
+from eapprocessor.hwsimulator.nonideal import get_rng
+
+
+def generate_capacitor_weights(resolution: int,
+                               mismatch_std: float = 0,
+                               n_channels: int = None,
+                               seed: Union[int, np.random.Generator] = None
+                               ) -> np.ndarray:
+    """Generate weights of a binary weighted capacitor DAC.
+
+    Bit i (MSB first) is made of 2**(resolution - 1 - i) unit capacitors
+    with independent mismatch, so its relative error has standard deviation
+    mismatch_std / sqrt(2**(resolution - 1 - i)).
+
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param mismatch_std: relative standard deviation of a unit capacitor
+    :type mismatch_std: float
+    :param n_channels: number of channels with their own DAC, None to share
+        a single DAC
+    :type n_channels: int
+    :param seed: seed or generator for the random values
+    :type seed: Union[int, np.random.Generator]
+    :return: weights in unit capacitors, with shape (resolution,) or
+        (channels, resolution)
+    :rtype: np.ndarray
+    """
+
+    rng = get_rng(seed)
+    nominal = 2.0**np.arange(resolution - 1, -1, -1)
+    shape = nominal.shape if n_channels is None else (n_channels, resolution)
+    error = rng.standard_normal(shape) * mismatch_std / np.sqrt(nominal)
+    return nominal * (1 + error)
+
+
+def convert_sar(matrix: np.ndarray,
+                voltage_ref: float,
+                resolution: int,
+                bipolar: bool = False,
+                weights: np.ndarray = None,
+                comparator_offset: Union[float, np.ndarray] = 0,
+                comparator_noise_std: float = 0,
+                seed: Union[int, np.random.Generator] = None,
+                dtype: type = np.float32) -> np.ndarray:
+    """Convert recordings simulating each cycle of a SAR converter.
+
+    Bits are decided from MSB to LSB, every decision compares all samples
+    and channels at once with the capacitor DAC output for the trial code,
+    so the cost grows with the number of bits and not with the samples.
+    The DAC has a dummy unit capacitor, so its full scale is the sum of the
+    weights plus one unit. With ideal weights and comparator, codes are the
+    ones of the flooring converter with saturation.
+
+    :param matrix: recordings with shape (channels, samples)
+    :type matrix: np.ndarray
+    :param voltage_ref: reference for converter
+    :type voltage_ref: float
+    :param resolution: resolution for converter
+    :type resolution: int
+    :param bipolar: type of converter
+    :type bipolar: bool
+    :param weights: capacitor weights as given by generate_capacitor_weights,
+        ideal binary weights by default
+    :type weights: np.ndarray
+    :param comparator_offset: offset of comparator, scalar or per channel
+    :type comparator_offset: Union[float, np.ndarray]
+    :param comparator_noise_std: standard deviation of comparator noise,
+        drawn for every decision
+    :type comparator_noise_std: float
+    :param seed: seed or generator for the random values
+    :type seed: Union[int, np.random.Generator]
+    :param dtype: floating type for the computation
+    :type dtype: type
+    :return: converted values with shape (channels, samples)
+    :rtype: np.ndarray
+    """
+
+    rng = get_rng(seed)
+    samples = np.array(matrix, dtype=dtype)
+    if samples.ndim == 1:
+        samples = samples.reshape(1, -1)
+
+    if weights is None:
+        weights = generate_capacitor_weights(resolution)
+    weights = np.asarray(weights, dtype=dtype)
+    if weights.ndim == 1:
+        weights = weights.reshape(1, -1)
+
+    if bipolar:
+        lowest = -float(voltage_ref)
+        full_scale = float(2 * voltage_ref)
+    else:
+        lowest = 0.0
+        full_scale = float(voltage_ref)
+
+    # Input and comparator errors in unit capacitors of the DAC
+    unit = full_scale / (np.sum(weights, axis=-1, keepdims=True) + 1)
+    samples -= dtype(lowest)
+    samples /= unit.astype(dtype)
+    offset = np.asarray(comparator_offset, dtype=dtype)
+    if offset.ndim:
+        offset = offset.reshape(-1, 1)
+    samples += offset / unit.astype(dtype)
+    noise_std = (comparator_noise_std / unit).astype(dtype)
+
+    code_dtype = get_code_dtype(resolution)
+    codes = np.zeros(samples.shape, dtype=code_dtype)
+    accumulated = np.zeros(samples.shape, dtype=dtype)
+    decision = np.empty(samples.shape, dtype=bool)
+    trial = np.empty(samples.shape, dtype=dtype)
+    noise = np.empty(samples.shape, dtype=dtype) \
+        if comparator_noise_std > 0 else None
+
+    for bit in range(resolution):
+        weight = weights[:, bit:bit + 1]
+        np.add(accumulated, weight, out=trial)
+        if noise is None:
+            np.greater_equal(samples, trial, out=decision)
+        else:
+            rng.standard_normal(out=noise, dtype=dtype)
+            noise *= noise_std
+            noise += samples
+            np.greater_equal(noise, trial, out=decision)
+        np.copyto(accumulated, trial, where=decision)
+        codes |= decision.astype(code_dtype) << (resolution - 1 - bit)
+
+    return codes
+
+
+if __name__ == "__main__":
+
+    import time
+    from eapprocessor.hwsimulator.adc import quantize_array
+
+    n_channels = 32
+    n_samples = 200000
+    resolution = 12
+    rng = np.random.default_rng(0)
+    recordings = rng.standard_normal((n_channels, n_samples)) * 100
+
+    ideal = convert_sar(recordings, 1000, resolution, bipolar=True,
+                        dtype=np.float64)
+    reference = np.clip(quantize_array(recordings, 1000, resolution,
+                                       bipolar=True),
+                        0, 2**resolution - 1)
+    print("Ideal equal to quantize:", np.array_equal(ideal, reference))
+
+    weights = generate_capacitor_weights(resolution, mismatch_std=0.01,
+                                         n_channels=n_channels, seed=1)
+    start = time.perf_counter()
+    codes = convert_sar(recordings, 1000, resolution, bipolar=True,
+                        weights=weights, comparator_offset=0.5,
+                        comparator_noise_std=0.2, seed=1)
+    elapsed = time.perf_counter() - start
+    print(f"SAR simulation of {n_channels}x{n_samples}: {elapsed:.3f} s")
+
+    histogram = np.bincount(codes.ravel(), minlength=2**resolution)
+    print("Codes never hit around mid scale:",
+          np.count_nonzero(histogram[1948:2148] == 0))
@@ -1,5 +1,5 @@
 #!/bin/python3
-from typing import Tuple, Union, Callable
+from typing import Tuple, Union, Callable, Dict, Iterable
 import numpy as np
 import numpy.typing as npt
 
@@ -9,8 +9,13 @@ import numpy.typing as npt
 
 from eapprocessor.mearec.api import load_recordings
 from eapprocessor.hwsimulator.adc \
-    import convert_array, convert_lcadc, normalize
-from eapprocessor.preprocessor.neo import apply_neo_to_array
+    import convert_array, normalize, compact_codes, get_code_dtype, \
+    quantize_resolutions
+from eapprocessor.hwsimulator.lcadc import convert_lcadc_matrix
+from eapprocessor.hwsimulator.deltasigma import convert_deltasigma_chunks
+from eapprocessor.preprocessor.neo import \
+    apply_neo_to_matrix, apply_neo_to_ragged, NEOProcessor
+from eapprocessor.tools.ragged import RaggedArray
 from eapprocessor.detector.threshold \
     import get_indexes_over_threshold_list_maximum
 
@@ -20,9 +25,11 @@ def convert_adc_recordings(
         voltage_ref: float,
         resolution: int,
         bipolar: bool = True,
-        operator: Callable[[float], int] = round) -> npt.NDArray[np.float64]:
+        operator: Callable[[float], int] = round) -> npt.NDArray[np.integer]:
     """Convert array of recordings to digital values.
 
+    Codes are kept with the smallest integer type that fits the resolution.
+
     :param dataset: array of recordings, shape length 2 [channel[recordings]]
     :type dataset: npt.NDArray[np.float64]
     :param voltage_ref: reference to convert recordings
@@ -30,20 +37,84 @@ def convert_adc_recordings(
     :param resolution: resolution for conversion
     :type resolution: int
     :return: Array of converted values
-    :rtype: npt.NDArray[np.float64]
+    :rtype: npt.NDArray[np.integer]
     """
 
     arrays = dataset[:, :].T
 
-    converted = [
-        convert_array(array,
-                      voltage_ref=voltage_ref,
-                      resolution=resolution,
-                      bipolar=bipolar,
-                      operator=operator) for array in arrays]
+    saveconverted = convert_array(arrays,
+                                  voltage_ref=voltage_ref,
+                                  resolution=resolution,
+                                  bipolar=bipolar,
+                                  operator=operator)
+    return compact_codes(saveconverted, resolution)
+
+
+def convert_adc_recordings_resolutions(
+        dataset: npt.NDArray[np.float64],
+        voltage_ref: float,
+        resolutions: Iterable[int],
+        bipolar: bool = True,
+        operator: Callable[[float], int] = round) -> Dict[
+            int, npt.NDArray[np.integer]]:
+    """Convert array of recordings to digital values for several resolutions.
+
+    Recordings are converted once, codes for each resolution are the same as
+    calling convert_adc_recordings with it.
 
-    saveconverted = np.array(converted)
-    return saveconverted
+    :param dataset: array of recordings, shape length 2 [channel[recordings]]
+    :type dataset: npt.NDArray[np.float64]
+    :param voltage_ref: reference to convert recordings
+    :type voltage_ref: float
+    :param resolutions: resolutions for conversion
+    :type resolutions: Iterable[int]
+    :return: Array of converted values for each resolution
+    :rtype: Dict[int, npt.NDArray[np.integer]]
+    """
+
+    arrays = dataset[:, :].T
+
+    converted = quantize_resolutions(arrays,
+                                     voltage_ref=voltage_ref,
+                                     resolutions=resolutions,
+                                     bipolar=bipolar,
+                                     operator=operator)
+    return {resolution: compact_codes(codes, resolution)
+            for resolution, codes in converted.items()}
+
+
+def convert_deltasigma_recordings(
+        dataset: npt.NDArray[np.float64],
+        voltage_ref: float,
+        resolution: int,
+        chunk_size: int = 100000,
+        **kwargs) -> npt.NDArray[np.integer]:
+    """Convert array of recordings with a delta-sigma or delta converter.
+
+    Recordings are read chunk by chunk, other keyword arguments (order, osr,
+    levels, mode, ...) are passed to DeltaSigmaConverter.
+
+    :param dataset: array of recordings, shape length 2 [channel[recordings]]
+    :type dataset: npt.NDArray[np.float64]
+    :param voltage_ref: reference to convert recordings
+    :type voltage_ref: float
+    :param resolution: resolution of decimated values
+    :type resolution: int
+    :param chunk_size: number of samples read per chunk
+    :type chunk_size: int
+    :return: Array of converted values
+    :rtype: npt.NDArray[np.integer]
+    """
+
+    converted = list(convert_deltasigma_chunks(dataset,
+                                               voltage_ref=voltage_ref,
+                                               resolution=resolution,
+                                               chunk_size=chunk_size,
+                                               **kwargs))
+    if len(converted) == 0:
+        return compact_codes(np.zeros((dataset.shape[1], 0), dtype=int),
+                             resolution)
+    return compact_codes(np.concatenate(converted, axis=1), resolution)
 
 
 def convert_lcadc_recordings(
@@ -52,10 +123,12 @@ def convert_lcadc_recordings(
     resolution: int,
     bipolar: bool = True,
     operator: Callable[[float],
-                       int] = round) -> Tuple[npt.NDArray[np.object_],
-                                              npt.NDArray[np.object_]]:
+                       int] = round) -> Tuple[RaggedArray, RaggedArray]:
     """Convert array of recordings with LCADC technique
 
+    Indexes and converted values of all channels are kept in flat arrays
+    sharing the offsets of each channel.
+
     :param dataset: array of recordings converted via LCADC,
         shape length 2 [channel[recordings]]
     :type dataset: npt.NDArray[np.float64]
@@ -63,34 +136,36 @@ def convert_lcadc_recordings(
     :type voltage_ref: float
     :param resolution: resolution for conversion
     :type resolution: int
-    :return: Array of converted values and indexes
-    :rtype: Tuple[npt.NDArray[np.object_],
-                                      npt.NDArray[np.object_]]
+    :return: Ragged arrays of indexes and converted values
+    :rtype: Tuple[RaggedArray, RaggedArray]
     """
 
     arrays = dataset[:, :].T
 
-    converted = []
-    indexes = []
-    for array in arrays:
-        index, convert = convert_lcadc(array, voltage_ref=voltage_ref,
-                                       resolution=resolution,
-                                       bipolar=bipolar,
-                                       operator=operator)
-        converted += [convert]
-        indexes += [index]
-
-    print(f'Lenght of converted { len(converted) }')
-    print(f'Lenght of indexes { len(indexes) }')
-    saveindexes = np.array(indexes, dtype=object)
-    saveconverted = np.array(converted, dtype=object)
+    indexes, converted = convert_lcadc_matrix(arrays,
+                                              voltage_ref=voltage_ref,
+                                              resolution=resolution,
+                                              bipolar=bipolar,
+                                              operator=operator)
+
+    saveindexes = RaggedArray.from_arrays(indexes, dtype=np.int64)
+    values = np.concatenate([np.zeros(0, dtype=np.int64)] + converted)
+    dtype = get_code_dtype(
+        resolution,
+        low=min(0, int(values.min())) if len(values) > 0 else 0,
+        high=max(0, int(values.max())) if len(values) > 0 else 0)
+    saveconverted = RaggedArray(values.astype(dtype), saveindexes.offsets)
+
+    print(f'Lenght of converted { len(saveconverted) }')
+    print(f'Lenght of indexes { len(saveindexes) }')
     return saveindexes, saveconverted
 
 
 def normalize_arrays(arrays: Union[npt.NDArray[np.float64],
                                    npt.NDArray[np.object_]],
                      resolution: int,
-                     bipolar: bool = True) -> npt.NDArray[np.float64]:
+                     bipolar: bool = True,
+                     dtype: type = np.float64) -> npt.NDArray[np.floating]:
     """Normalize array of array of converted values
 
     :param arrays: Array of array of converted values, dimension length 2
@@ -98,26 +173,167 @@ def normalize_arrays(arrays: Union[npt.NDArray[np.float64],
     :type arrays: npt.NDArray[np.float64]
     :param resolution: resolution with those were converted
     :type resolution: int
+    :param dtype: floating type of normalized values
+    :type dtype: type
     :return: array of array of normalized values [channel[normalized]]
-    :rtype: npt.NDArray[np.float64]
+    :rtype: npt.NDArray[np.floating]
     """
 
+    if isinstance(arrays, np.ndarray) and arrays.dtype != object:
+        return normalize(arrays, resolution=resolution,
+                         bipolar=bipolar).astype(dtype, copy=False)
+
     normalized = [
         normalize(
             array,
             resolution=resolution,
-            bipolar=bipolar) for array in arrays]
+            bipolar=bipolar).astype(dtype, copy=False) for array in arrays]
     return np.array(normalized)
 
 
 def apply_neo_to_dataset(dataset, w=1):
 
     print("Applying neo to dataset with w=", w)
-    preprocessed = [
-        apply_neo_to_array(array, w=w) for array in dataset]
+    if not isinstance(dataset, RaggedArray):
+        return apply_neo_to_matrix(dataset, [w])[0]
+
+    return apply_neo_to_ragged(dataset, w=w)
+
+
+def get_block_code_dtype(resolution: int) -> np.dtype:
+    """Get the type of codes converted block by block.
+
+    It fits codes of recordings up to a whole range beyond the reference at
+    each side, as the actual codes are not known before converting.
+
+    :param resolution: resolution for conversion
+    :type resolution: int
+    :return: signed integer type
+    :rtype: np.dtype
+    """
+
+    return get_code_dtype(resolution, low=-2**resolution,
+                          high=2**(resolution + 1) - 1)
+
+
+def preprocess_adc_recordings(
+        dataset: npt.NDArray[np.float64],
+        voltage_ref: float,
+        resolution: int,
+        w: Iterable[int] = [1],
+        bipolar: bool = True,
+        operator: Callable[[float], int] = round,
+        block_size: int = 100000,
+        normalized_dtype: type = np.float64,
+        neo_dtype: type = None,
+        keep_adc: bool = False,
+        keep_normalized: bool = False,
+        adc_dtype: type = None,
+        out: Dict[str, npt.ArrayLike] = None) -> Dict[str, npt.ArrayLike]:
+    """Convert, normalize and apply NEO to recordings block by block.
+
+    Each block of samples of all channels goes from recordings to codes,
+    normalized values and NEO before the next one is read, so only NEO is
+    kept for the whole recording; codes and normalized values are written
+    block by block too, when kept. Values are the same as
+    convert_adc_recordings, normalize_arrays and apply_neo_to_matrix, bit
+    by bit, with the NEO state carried between blocks by NEOProcessor.
+    Returned codes are widened when a block does not fit and compacted at
+    the end, so they have the type of convert_adc_recordings, unless an
+    adc_dtype is given. Codes of out keep its type, get_block_code_dtype
+    for get_preprocessed, so codes out of it, of recordings more than a
+    whole range beyond the reference, raise an AttributeError.
+
+    :param dataset: array of recordings with shape (samples, channels),
+        e.g. HDF5 dataset
+    :type dataset: npt.NDArray[np.float64]
+    :param voltage_ref: reference to convert recordings
+    :type voltage_ref: float
+    :param resolution: resolution for conversion
+    :type resolution: int
+    :param w: NEO widths
+    :type w: Iterable[int]
+    :param block_size: number of samples per block
+    :type block_size: int
+    :param normalized_dtype: floating type of normalized values
+    :type normalized_dtype: type
+    :param neo_dtype: type of NEO, the one of normalized values by default
+    :type neo_dtype: type
+    :param keep_adc: also return codes with shape (channels, samples)
+    :type keep_adc: bool
+    :param keep_normalized: also return normalized values with shape
+        (channels, samples)
+    :type keep_normalized: bool
+    :param adc_dtype: integer type of kept codes, get_block_code_dtype
+        while converting by default
+    :type adc_dtype: type
+    :param out: preallocated outputs by name, "neo" with shape (W,
+        channels, samples), "adc" and "normalized", e.g. HDF5 datasets
+    :type out: Dict[str, npt.ArrayLike]
+    :return: dictionary with neo, and adc and normalized if kept
+    :rtype: Dict[str, npt.ArrayLike]
+    """
 
-    saveconverted = np.array(preprocessed)
-    return saveconverted
+    n_samples, n_channels = dataset.shape
+    widths = np.atleast_1d(w).astype(int)
+    neo_dtype = normalized_dtype if neo_dtype is None else neo_dtype
+
+    outputs = {} if out is None else dict(out)
+    if "neo" not in outputs:
+        outputs["neo"] = np.empty((len(widths), n_channels, n_samples),
+                                  dtype=neo_dtype)
+    if keep_adc and "adc" not in outputs:
+        if adc_dtype is None:
+            adc_dtype = get_block_code_dtype(resolution)
+        outputs["adc"] = np.empty((n_channels, n_samples), dtype=adc_dtype)
+    if keep_normalized and "normalized" not in outputs:
+        outputs["normalized"] = np.empty((n_channels, n_samples),
+                                         dtype=normalized_dtype)
+
+    neo = outputs["neo"]
+    # Only codes allocated here can change their type
+    own_adc = "adc" in outputs and (out is None or "adc" not in out)
+    if "adc" in outputs:
+        code_range = np.iinfo(outputs["adc"].dtype)
+    processor = NEOProcessor(n_channels, w=widths, dtype=neo_dtype)
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        converted = convert_array(dataset[start:stop, :].T,
+                                  voltage_ref=voltage_ref,
+                                  resolution=resolution,
+                                  bipolar=bipolar,
+                                  operator=operator)
+        normalized = normalize(converted, resolution=resolution,
+                               bipolar=bipolar).astype(normalized_dtype,
+                                                       copy=False)
+        if "adc" in outputs:
+            if converted.size > 0 and (converted.min() < code_range.min or
+                                       converted.max() > code_range.max):
+                if not own_adc:
+                    raise AttributeError(f"Codes of samples {start} to "
+                                         f"{stop} do not fit in "
+                                         f"{code_range.dtype}, give a wider "
+                                         "adc_dtype")
+                dtype = get_code_dtype(
+                    resolution,
+                    low=min(int(converted.min()), int(code_range.min)),
+                    high=max(int(converted.max()), int(code_range.max)))
+                outputs["adc"] = outputs["adc"].astype(dtype)
+                code_range = np.iinfo(dtype)
+            outputs["adc"][:, start:stop] = converted
+        if "normalized" in outputs:
+            outputs["normalized"][:, start:stop] = normalized
+
+        first, values = processor.process(normalized)
+        neo[:, :, first:first + values.shape[2]] = values
+
+    for first, values in processor.flush():
+        neo[:, :, first:first + values.shape[2]] = values
+
+    if own_adc and adc_dtype is None:
+        outputs["adc"] = compact_codes(outputs["adc"], resolution)
+
+    return outputs
 
 
 def evaluate_threshold_maximum(dataset, number=100, absolute=False):
@@ -1,9 +1,17 @@
 #!/bin/python3
 import numpy as np
+from typing import Iterator, List, Tuple, Union
+
+from eapprocessor.tools.ragged import RaggedArray
+from eapprocessor.tools.reconstruct import KIND_ZOH, KIND_LINEAR
 
 
 def apply_neo_to_array(values, w=1):
     print("Apply to recording with w=", w)
+    return apply_neo_roll(values, w=w)
+
+
+def apply_neo_roll(values, w=1):
     newarray = np.array(values)
     # for idx in range(len(values))[w:-w]:
     #     newarray[idx] = values[idx]**2 - values[idx + w] * values[idx - w]
@@ -18,6 +26,379 @@ def apply_neo_to_array(values, w=1):
     return operation * mask + newarray * (~mask)
 
 
+def apply_neo_positions(values, positions, n_samples, w=1):
+    """Apply NEO to some positions as apply_neo_roll does over the signal.
+
+    :param values: callable giving values with shape (channels, positions)
+        of the given global positions
+    :param positions: global positions to compute
+    :param n_samples: total samples of the signal
+    """
+
+    current = values(positions)
+    operation = (current**2 -
+                 values((positions - w) % n_samples) *
+                 values((positions + w) % n_samples))
+    mask = (positions >= w) * (positions < n_samples - w)
+    return operation * mask + current * (~mask)
+
+
+def apply_neo_to_matrix(matrix: np.ndarray,
+                        w: Union[int, List[int]] = [1],
+                        dtype: type = None,
+                        out: np.ndarray = None) -> np.ndarray:
+    """Apply NEO with every w to all channels at once.
+
+    The squared values are computed once for all w, and the products of
+    each w are written with slices into one output array, with no roll
+    copies nor masks. Values are the ones of apply_neo_to_array, bit by bit:
+    the first and last w samples of each channel are kept, as are channels
+    with non finite values, which use the original formula.
+
+    :param matrix: values with shape (channels, samples) or (samples,)
+    :type matrix: np.ndarray
+    :param w: NEO widths
+    :type w: Union[int, List[int]]
+    :param dtype: type of the computation, e.g. np.float32, the one of
+        matrix by default
+    :type dtype: type
+    :param out: preallocated output with shape (W, channels, samples)
+    :type out: np.ndarray
+    :return: NEO values with shape (W, channels, samples)
+    :rtype: np.ndarray
+    """
+
+    values = np.asarray(matrix, dtype=dtype)
+    if values.ndim == 1:
+        values = values.reshape(1, -1)
+    widths = np.atleast_1d(w).astype(int)
+    n_channels, n_samples = values.shape
+    if out is None:
+        out = np.empty((len(widths), n_channels, n_samples),
+                       dtype=values.dtype)
+
+    squared = np.square(values)
+    positions = np.arange(n_samples)
+    for idx, width in enumerate(widths):
+        neo = out[idx]
+        if n_samples > 2 * width:
+            inner = neo[:, width:n_samples - width]
+            np.multiply(values[:, :n_samples - 2 * width],
+                        values[:, 2 * width:], out=inner)
+            np.subtract(squared[:, width:n_samples - width], inner,
+                        out=inner)
+
+        # Samples out of [w, N - w) keep their value as with the masks
+        edges = positions[(positions < width) |
+                          (positions >= n_samples - width)]
+        if len(edges) > 0:
+            operation = squared[:, edges] - \
+                values[:, (edges - width) % n_samples] * \
+                values[:, (edges + width) % n_samples]
+            neo[:, edges] = operation * values.dtype.type(0) + \
+                values[:, edges]
+
+    if np.issubdtype(values.dtype, np.floating):
+        # Masks turn non finite values into NaN where slices would not
+        for channel in np.flatnonzero(~np.isfinite(values).all(axis=-1)):
+            for idx, width in enumerate(widths):
+                out[idx, channel] = apply_neo_roll(values[channel],
+                                                   w=width)
+
+    return out
+
+
+def apply_neo_to_ragged(dataset: RaggedArray, w: int = 1) -> RaggedArray:
+    """Apply NEO to every channel of ragged values in one call.
+
+    Neighbours are gathered from the flat values, wrapping around inside
+    each channel, and the formula of apply_neo_roll is applied to all
+    channels at once, so values are the ones of apply_neo_to_array on each
+    channel, bit by bit.
+
+    :param dataset: values per channel, e.g. normalized LCADC values
+    :type dataset: RaggedArray
+    :param w: NEO width
+    :type w: int
+    :return: NEO values sharing offsets of dataset
+    :rtype: RaggedArray
+    """
+
+    values = np.asarray(dataset.values[:])
+    lengths = dataset.lengths
+    starts = np.repeat(dataset.offsets[:-1], lengths)
+    sizes = np.repeat(lengths, lengths)
+    local = np.arange(len(values)) - starts
+
+    operation = (values**2 -
+                 values[starts + (local - w) % np.maximum(sizes, 1)] *
+                 values[starts + (local + w) % np.maximum(sizes, 1)])
+    mask = (local >= w) * (local < sizes - w)
+    return RaggedArray(operation * mask + values * (~mask), dataset.offsets)
+
+
+def lookup_events(keys, values, queries, lower, upper, kind=KIND_ZOH):
+    """Get values of event signals at query positions.
+
+    Keys are sorted positions of events of all channels, and each query
+    only looks at the events between lower and upper (included) of its
+    channel. Values are held before the first and after the last event.
+    """
+
+    before = np.searchsorted(keys, queries, side='right') - 1
+    before = np.clip(before, lower, upper)
+    if kind == KIND_ZOH:
+        return values[before]
+
+    after = np.minimum(before + 1, upper)
+    span = keys[after] - keys[before]
+    fraction = np.clip((queries - keys[before]) / np.maximum(span, 1), 0, 1)
+    return values[before] + fraction.astype(values.dtype) * (
+        values[after] - values[before])
+
+
+def apply_neo_to_events(indexes, values, n_samples: int,
+                        w: Union[int, List[int]] = [1],
+                        kind: str = KIND_ZOH) -> List[RaggedArray]:
+    """Apply NEO to LCADC events with neighbours w samples away in time.
+
+    NEO of the event at sample t is x(t)**2 - x(t - w) * x(t + w), where
+    x is the value of the channel at a sample, held from the latest event
+    (KIND_ZOH) or interpolated between events (KIND_LINEAR), as done by
+    tools.reconstruct, but without expanding channels to the sample grid.
+    Events with t < w or t >= n_samples - w keep their value, as the
+    edges of apply_neo_to_array. All channels are looked up at once on
+    the events flattened as channel * n_samples + t.
+
+    :param indexes: event indexes per channel, RaggedArray or list
+    :param values: event values per channel, e.g. normalized values
+    :param n_samples: samples of the original grid
+    :type n_samples: int
+    :param w: NEO widths in samples
+    :type w: Union[int, List[int]]
+    :param kind: KIND_ZOH or KIND_LINEAR
+    :type kind: str
+    :return: NEO values of the events for each w, sharing offsets of
+        indexes
+    :rtype: List[RaggedArray]
+    """
+
+    if kind not in (KIND_ZOH, KIND_LINEAR):
+        raise AttributeError(f"Unknown event lookup {kind}")
+    if not isinstance(indexes, RaggedArray):
+        indexes = RaggedArray.from_arrays(indexes, dtype=np.int64)
+    if isinstance(values, RaggedArray):
+        flat = np.asarray(values.values[:])
+    else:
+        flat = RaggedArray.from_arrays(values).values
+
+    offsets = indexes.offsets
+    lengths = indexes.lengths
+    channel = np.repeat(np.arange(len(indexes)), lengths)
+    times = np.asarray(indexes.values[:], dtype=np.int64)
+    keys = channel * n_samples + times
+    lower = np.repeat(offsets[:-1], lengths)
+    upper = np.repeat(offsets[1:] - 1, lengths)
+    squared = np.square(flat)
+
+    neo = []
+    for width in np.atleast_1d(w).astype(int):
+        previous = lookup_events(keys, flat, keys - width, lower, upper,
+                                 kind=kind)
+        following = lookup_events(keys, flat, keys + width, lower, upper,
+                                  kind=kind)
+        inner = (times >= width) & (times < n_samples - width)
+        neo += [RaggedArray(np.where(inner, squared - previous * following,
+                                     flat), offsets)]
+
+    return neo
+
+
+class NEOProcessor:
+    """Stateful NEO for chunked processing of long recordings.
+
+    Only the last 2 * max(w) samples of each channel are carried between
+    chunks, plus the first 2 * max(w) samples of the recording, which are
+    needed at its end because apply_neo_to_array wraps around. Values are
+    the ones of apply_neo_to_array over the whole recording. Every chunk
+    gives the samples whose neighbours are already known; the first and
+    last max(w) samples of the recording are given by flush.
+
+    :param n_channels: number of channels of the chunks
+    :type n_channels: int
+    :param w: NEO widths
+    :type w: Union[int, List[int]]
+    :param dtype: type of the computation, the one of chunks by default
+    :type dtype: type
+    """
+
+    def __init__(self, n_channels: int, w: Union[int, List[int]] = [1],
+                 dtype: type = None):
+
+        self.n_channels = n_channels
+        self.widths = np.atleast_1d(w).astype(int)
+        self.overlap = int(self.widths.max(initial=0))
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        """Forget the state, next chunk is taken as start of recording."""
+
+        self.position = 0
+        self.emitted = self.overlap
+        self.head = None
+        self.tail = None
+
+    def process(self, chunk: np.ndarray) -> Tuple[int, np.ndarray]:
+        """Apply NEO to the next chunk of the recording.
+
+        :param chunk: values with shape (channels, samples)
+        :type chunk: np.ndarray
+        :return: global position of the first sample and NEO values with
+            shape (W, channels, samples)
+        :rtype: Tuple[int, np.ndarray]
+        """
+
+        chunk = np.asarray(chunk, dtype=self.dtype)
+        if chunk.shape[0] != self.n_channels:
+            raise AttributeError(f"Chunk has {chunk.shape[0]} channels, "
+                                 f"expected {self.n_channels}")
+
+        if self.tail is None:
+            self.tail = chunk[:, :0]
+            self.head = chunk[:, :0]
+        if self.head.shape[1] < 2 * self.overlap:
+            self.head = np.concatenate(
+                (self.head, chunk[:, :2 * self.overlap -
+                                  self.head.shape[1]]), axis=1)
+
+        data = np.concatenate((self.tail, chunk), axis=1)
+        start = self.position - self.tail.shape[1]
+        self.position += chunk.shape[1]
+        self.tail = data[:, max(data.shape[1] - 2 * self.overlap, 0):]
+
+        # Samples with max(w) known neighbours at each side
+        first = self.emitted
+        last = max(self.position - self.overlap, first)
+        self.emitted = last
+        window = data[:, first - self.overlap - start:
+                      last + self.overlap - start]
+        neo = apply_neo_to_matrix(window, self.widths)
+        return first, neo[:, :, self.overlap:self.overlap + last - first]
+
+    def flush(self) -> List[Tuple[int, np.ndarray]]:
+        """Finish the recording and reset the processor.
+
+        :return: list of global position of the first sample and NEO values
+            with shape (W, channels, samples), for the remaining samples and
+            for the first max(w) samples of the recording
+        :rtype: List[Tuple[int, np.ndarray]]
+        """
+
+        n_samples = self.position
+        if self.tail is None or n_samples == 0:
+            self.reset()
+            return []
+
+        head = self.head
+        tail = self.tail
+        tail_start = n_samples - tail.shape[1]
+
+        def values(positions):
+            in_head = positions < head.shape[1]
+            gathered = np.empty((self.n_channels, len(positions)),
+                                dtype=tail.dtype)
+            gathered[:, in_head] = head[:, positions[in_head]]
+            gathered[:, ~in_head] = tail[:, positions[~in_head] -
+                                         tail_start]
+            return gathered
+
+        blocks = []
+        ranges = [(min(self.emitted, n_samples), n_samples),
+                  (0, min(self.overlap, n_samples))]
+        if self.emitted > n_samples:
+            ranges = [(0, n_samples)]
+        for first, last in ranges:
+            if last <= first:
+                continue
+            positions = np.arange(first, last)
+            neo = np.empty((len(self.widths), self.n_channels,
+                            len(positions)), dtype=tail.dtype)
+            for idx, width in enumerate(self.widths):
+                neo[idx] = apply_neo_positions(values, positions, n_samples,
+                                               w=width)
+            blocks += [(first, neo)]
+
+        self.reset()
+        return blocks
+
+
+def apply_neo_chunks(dataset, w: Union[int, List[int]] = [1],
+                     chunk_size: int = 100000,
+                     dtype: type = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """Apply NEO to a recording reading it chunk by chunk.
+
+    :param dataset: values with shape (channels, samples), e.g. normalized
+        HDF5 dataset or NormalizedCodes of converted values
+    :param w: NEO widths
+    :type w: Union[int, List[int]]
+    :param chunk_size: number of samples read per chunk
+    :type chunk_size: int
+    :param dtype: type of the computation
+    :type dtype: type
+    :return: iterator of global position and NEO values with shape
+        (W, channels, samples)
+    :rtype: Iterator[Tuple[int, np.ndarray]]
+    """
+
+    n_channels, n_samples = dataset.shape
+    processor = NEOProcessor(n_channels, w=w, dtype=dtype)
+    for start in range(0, n_samples, chunk_size):
+        yield processor.process(dataset[:, start:start + chunk_size])
+    for block in processor.flush():
+        yield block
+
+
+class StreamedNEO:
+    """NEO values of a recording computed chunk by chunk when written.
+
+    :param dataset: values with shape (channels, samples)
+    :param w: NEO widths
+    :param chunk_size: number of samples read per chunk
+    :param dtype: type of the computation
+    """
+
+    def __init__(self, dataset, w: Union[int, List[int]] = [1],
+                 chunk_size: int = 100000, dtype: type = None):
+        self.dataset = dataset
+        self.w = np.atleast_1d(w).astype(int)
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype) if dtype is not None else \
+            np.asarray(dataset[:, :0]).dtype
+
+    @property
+    def shape(self):
+        return (len(self.w),) + tuple(self.dataset.shape)
+
+    def __len__(self):
+        return len(self.w)
+
+    def write(self, out):
+        """Write NEO values into out, e.g. an HDF5 dataset of self.shape."""
+
+        for start, neo in apply_neo_chunks(self.dataset, w=self.w,
+                                           chunk_size=self.chunk_size,
+                                           dtype=self.dtype):
+            out[:, :, start:start + neo.shape[2]] = neo
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        neo = self.write(np.empty(self.shape, dtype=self.dtype))
+        if dtype is not None:
+            neo = neo.astype(dtype, copy=False)
+        return neo
+
+
 if __name__ == "__main__":
 
     import matplotlib.pylab as plt
@@ -26,6 +407,12 @@ if __name__ == "__main__":
     print(array)
     print(neoarray)
 
+    indexes = np.array([0, 1, 4, 5, 7])
+    events = apply_neo_to_events([indexes], [array[indexes]], len(array),
+                                 w=[1])
+    print(events[0][0])
+
     plt.plot(array)
     plt.plot(neoarray)
+    plt.plot(indexes, events[0][0], 'o')
     plt.show()
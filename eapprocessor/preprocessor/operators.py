@@ -0,0 +1,207 @@
+#!/bin/python3
+import numpy as np
+from scipy import ndimage
+from scipy.signal import windows
+from typing import Dict, List, Union
+
+from eapprocessor.preprocessor.neo import apply_neo_to_matrix
+from eapprocessor.tools.ragged import RaggedArray
+
+OPERATOR_NEO = "neo"
+OPERATOR_MTEO = "mteo"
+OPERATOR_ASO = "aso"
+OPERATOR_SNEO = "sneo"
+
+
+def get_cached_neo(values: np.ndarray, width: int, cache: dict) -> np.ndarray:
+    """Get NEO of all channels with a width, computed once per cache.
+
+    :param values: values with shape (channels, samples)
+    :type values: np.ndarray
+    :param width: NEO width
+    :type width: int
+    :param cache: NEO values already computed, by width
+    :type cache: dict
+    :return: NEO values with shape (channels, samples)
+    :rtype: np.ndarray
+    """
+
+    width = int(width)
+    if width not in cache:
+        cache[width] = apply_neo_to_matrix(values, [width])[0]
+    return cache[width]
+
+
+def apply_neo_operator(values: np.ndarray, parameters: List[int],
+                       cache: dict) -> np.ndarray:
+    """Apply NEO, as apply_neo_to_matrix, with each width of parameters.
+
+    :param values: values with shape (channels, samples)
+    :type values: np.ndarray
+    :param parameters: NEO widths
+    :type parameters: List[int]
+    :param cache: NEO values already computed, by width
+    :type cache: dict
+    :return: values with shape (parameters, channels, samples)
+    :rtype: np.ndarray
+    """
+
+    return np.stack([get_cached_neo(values, width, cache)
+                     for width in parameters])
+
+
+def apply_mteo_operator(values: np.ndarray,
+                        parameters: List[Union[int, List[int]]],
+                        cache: dict) -> np.ndarray:
+    """Apply the multi-resolution TEO, the maximum of NEO over several k.
+
+    :param values: values with shape (channels, samples)
+    :type values: np.ndarray
+    :param parameters: set of widths k of each output, e.g. [[1, 3, 5]]
+    :type parameters: List[Union[int, List[int]]]
+    :param cache: NEO values already computed, by width
+    :type cache: dict
+    :return: values with shape (parameters, channels, samples)
+    :rtype: np.ndarray
+    """
+
+    return np.stack([
+        np.max([get_cached_neo(values, width, cache)
+                for width in np.atleast_1d(widths)], axis=0)
+        for widths in parameters])
+
+
+def apply_aso_operator(values: np.ndarray, parameters: List[int],
+                       cache: dict) -> np.ndarray:
+    """Apply the amplitude slope operator, x(n) * (x(n) - x(n - k)).
+
+    The first k samples of each channel, without x(n - k), are 0.
+
+    :param values: values with shape (channels, samples)
+    :type values: np.ndarray
+    :param parameters: slope distances k
+    :type parameters: List[int]
+    :param cache: NEO values already computed, not used
+    :type cache: dict
+    :return: values with shape (parameters, channels, samples)
+    :rtype: np.ndarray
+    """
+
+    n_samples = values.shape[-1]
+    out = np.zeros((len(parameters),) + values.shape, dtype=values.dtype)
+    for idx, width in enumerate(np.asarray(parameters, dtype=int)):
+        if width < n_samples:
+            inner = out[idx, :, width:]
+            np.subtract(values[:, width:], values[:, :n_samples - width],
+                        out=inner)
+            np.multiply(values[:, width:], inner, out=inner)
+    return out
+
+
+def apply_sneo_operator(values: np.ndarray, parameters: List[int],
+                        cache: dict) -> np.ndarray:
+    """Apply NEO smoothed with a Bartlett window of 4w + 1 samples.
+
+    The window is scaled to unit sum, so the smoothed values keep the scale
+    of NEO, and samples out of the channel are taken as 0.
+
+    :param values: values with shape (channels, samples)
+    :type values: np.ndarray
+    :param parameters: NEO widths
+    :type parameters: List[int]
+    :param cache: NEO values already computed, by width
+    :type cache: dict
+    :return: values with shape (parameters, channels, samples)
+    :rtype: np.ndarray
+    """
+
+    smoothed = []
+    for width in parameters:
+        window = windows.bartlett(4 * int(width) + 1)
+        window = (window / np.sum(window)).astype(values.dtype)
+        smoothed += [ndimage.convolve1d(get_cached_neo(values, width, cache),
+                                        window, axis=-1, mode='constant')]
+    return np.stack(smoothed)
+
+
+OPERATORS = {
+    OPERATOR_NEO: apply_neo_operator,
+    OPERATOR_MTEO: apply_mteo_operator,
+    OPERATOR_ASO: apply_aso_operator,
+    OPERATOR_SNEO: apply_sneo_operator,
+}
+
+
+def register_operator(name: str, operator) -> None:
+    """Add an operator to the registry.
+
+    :param name: name to call the operator with
+    :type name: str
+    :param operator: callable with arguments values with shape (channels,
+        samples), list of parameters and NEO cache, returning values with
+        shape (parameters, channels, samples)
+    """
+
+    OPERATORS[name] = operator
+
+
+def get_operator(name: str):
+
+    if name not in OPERATORS:
+        raise AttributeError(f"Unknown operator {name}")
+    return OPERATORS[name]
+
+
+def apply_operators(matrix: np.ndarray,
+                    operators: Dict[str, list] = {OPERATOR_NEO: [1]},
+                    dtype: type = None) -> Dict[str, np.ndarray]:
+    """Apply several operators of the registry to all channels at once.
+
+    NEO of each width is computed once and shared by the operators built
+    on it, e.g. neo, mteo and sneo with the same widths.
+
+    :param matrix: values with shape (channels, samples) or (samples,)
+    :type matrix: np.ndarray
+    :param operators: parameters of each operator by name, e.g.
+        {"neo": [1, 2], "mteo": [[1, 3, 5]], "aso": [1], "sneo": [1]}
+    :type operators: Dict[str, list]
+    :param dtype: floating type of the computation, e.g. np.float32, the
+        one of matrix by default, or np.float64 for integer matrices
+    :type dtype: type
+    :return: values with shape (parameters, channels, samples) by name
+    :rtype: Dict[str, np.ndarray]
+    """
+
+    if isinstance(matrix, RaggedArray):
+        raise AttributeError("Operators need values with the same samples "
+                             "in every channel, not ragged LCADC values")
+    values = np.asarray(matrix, dtype=dtype)
+    if not np.issubdtype(values.dtype, np.floating):
+        # Integer codes would wrap around in products and differences
+        values = values.astype(np.float64)
+    if values.ndim == 1:
+        values = values.reshape(1, -1)
+
+    cache = {}
+    return {name: get_operator(name)(values, list(parameters), cache)
+            for name, parameters in operators.items()}
+
+
+if __name__ == "__main__":
+
+    import time
+
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((32, 100000)).astype(np.float32)
+    operators = {OPERATOR_NEO: [1, 3, 5], OPERATOR_MTEO: [[1, 3, 5]],
+                 OPERATOR_ASO: [1], OPERATOR_SNEO: [1, 3]}
+
+    start = time.perf_counter()
+    results = apply_operators(matrix, operators)
+    print(f"Operators in {time.perf_counter() - start:.3f} s")
+    for name, values in results.items():
+        print(name, values.shape, values.dtype)
+
+    print("MTEO is the maximum of NEO:",
+          np.array_equal(results[OPERATOR_MTEO][0],
+                         results[OPERATOR_NEO].max(axis=0)))
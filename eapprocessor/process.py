@@ -1,15 +1,25 @@
 #!/bin/python
 import time
 from pathlib import Path
+import h5py
 import numpy as np
 from eapprocessor.tools.save import save_converted_values, save_neo_values, \
-    save_indexes_and_counts
+    save_indexes_and_counts, save_lcadc_sweep, save_operator_values, \
+    save_preprocessed_values_to_file
 from eapprocessor.integrate import convert_adc_recordings, \
+    convert_adc_recordings_resolutions, convert_deltasigma_recordings, \
     convert_lcadc_recordings, \
     normalize_arrays, \
-    apply_neo_to_dataset, evaluate_threshold_maximum, \
+    apply_neo_to_dataset, preprocess_adc_recordings, get_block_code_dtype, \
+    evaluate_threshold_maximum, \
     evaluate_threshold_maximum_array
 from eapprocessor.mearec.api import load_recordings
+from eapprocessor.hwsimulator.adc import NormalizedCodes
+from eapprocessor.hwsimulator.lcadc import sweep_lcadc
+from eapprocessor.hwsimulator.deltasigma import MODE_DELTA_SIGMA
+from eapprocessor.preprocessor.neo import apply_neo_to_matrix, \
+    apply_neo_to_events, StreamedNEO
+from eapprocessor.preprocessor.operators import apply_operators, OPERATOR_NEO
 from eapprocessor.tools.load import load_converted_values, load_neo, \
     load_count_evaluation, load_indexes, load_channels
 
@@ -18,6 +28,8 @@ from eapprocessor.evaluator.spikes import \
 
 
 from eapprocessor.tools.cast import convert_to_list
+from eapprocessor.tools.ragged import RaggedArray
+from eapprocessor.tools.reconstruct import reconstruct, KIND_ZOH
 from eapprocessor.tools.indexes import \
     project_values_array_list_to_indexes_array, \
     project_values_array_to_indexes_array
@@ -28,6 +40,7 @@ default_dir = Path(DEFAULT_OUTPUT)
 
 FOLDER_ADC = "adc"
 FOLDER_LCADC = "lcadc"
+FOLDER_DELTASIGMA = "deltasigma"
 FOLDER_PREPROCESSOR = "preprocessor"
 FOLDER_PREPROCESSOR_LCADC = "preprocessor_lcadc"
 FOLDER_EVALUATOR = "evaluator"
@@ -40,7 +53,8 @@ def get_converted_adc(recfile=None,
                       noise_level=None,
                       fs=None,
                       verbose=True,
-                      is_lcadc=False):
+                      is_lcadc=False,
+                      normalized_dtype=None):
 
     recfile = Path(recfile)
     recgen = load_recordings(datafolder=recfile,
@@ -55,7 +69,7 @@ def get_converted_adc(recfile=None,
             recgen.recordings,
             voltage_ref=voltage_ref,
             resolution=resolution)
-        normalized = normalize_arrays(lcadc, resolution=resolution)
+        normalized = get_normalized(lcadc, resolution, normalized_dtype)
         adcgen["lcadc"] = lcadc
         adcgen["indexes"] = indexes
         adcgen["normalized"] = normalized
@@ -65,7 +79,7 @@ def get_converted_adc(recfile=None,
             voltage_ref=voltage_ref,
             resolution=resolution)
 
-        normalized = normalize_arrays(adc, resolution=resolution)
+        normalized = get_normalized(adc, resolution, normalized_dtype)
         adcgen["adc"] = adc
         adcgen["normalized"] = normalized
 
@@ -75,18 +89,194 @@ def get_converted_adc(recfile=None,
     }
     adcgen["recordings"] = recgen
 
+    save_converted_adc(adcgen, recfile, is_lcadc=is_lcadc)
+
+    return adcgen
+
+
+def get_converted_adc_resolutions(recfile=None,
+                                  voltage_ref=1000,
+                                  resolutions=[12],
+                                  noise_level=None,
+                                  fs=None,
+                                  verbose=True,
+                                  is_lcadc=False,
+                                  normalized_dtype=None):
+    """Convert recordings for several resolutions loading them once.
+
+    For the SAR model the recordings are quantized once and codes for every
+    resolution are derived from that conversion. LCADC values are converted
+    for each resolution. Each resolution is saved to the same file that
+    get_converted_adc would write.
+
+    :return: dictionary of converted values for each resolution
+    :rtype: dict
+    """
+
+    recfile = Path(recfile)
+    recgen = load_recordings(datafolder=recfile,
+                             noise_level=noise_level,
+                             fs=fs,
+                             verbose=verbose)
+
+    if not is_lcadc:
+        converted = convert_adc_recordings_resolutions(
+            recgen.recordings,
+            voltage_ref=voltage_ref,
+            resolutions=resolutions)
+
+    adcgen_resolutions = {}
+    for resolution in resolutions:
+        adcgen = {}
+        if is_lcadc:
+            indexes, lcadc = convert_lcadc_recordings(
+                recgen.recordings,
+                voltage_ref=voltage_ref,
+                resolution=resolution)
+            adcgen["lcadc"] = lcadc
+            adcgen["indexes"] = indexes
+            adcgen["normalized"] = get_normalized(lcadc, resolution,
+                                                  normalized_dtype)
+        else:
+            adc = converted[resolution]
+            adcgen["adc"] = adc
+            adcgen["normalized"] = get_normalized(adc, resolution,
+                                                  normalized_dtype)
+
+        adcgen["adcinfo"] = {
+            "voltage_ref": voltage_ref,
+            "resolution": resolution
+        }
+        adcgen["recordings"] = recgen
+
+        save_converted_adc(adcgen, recfile, is_lcadc=is_lcadc)
+        adcgen_resolutions[resolution] = adcgen
+
+    return adcgen_resolutions
+
+
+def get_converted_deltasigma(recfile=None,
+                             voltage_ref=1000,
+                             resolution=12,
+                             order=1,
+                             osr=64,
+                             levels=2,
+                             mode=MODE_DELTA_SIGMA,
+                             noise_level=None,
+                             fs=None,
+                             verbose=True,
+                             chunk_size=100000,
+                             normalized_dtype=None,
+                             segment_length=None,
+                             warmup=16):
+    """Convert recordings with a delta-sigma or delta converter.
+
+    Converted values are saved with the same format as get_converted_adc,
+    in its own folder, and adcinfo includes the converter parameters. With
+    a segment_length, segments of each chunk are modulated at once, which
+    is much faster but not bit-identical, see DeltaSigmaConverter.
+    """
+
+    recfile = Path(recfile)
+    recgen = load_recordings(datafolder=recfile,
+                             noise_level=noise_level,
+                             fs=fs,
+                             verbose=verbose)
+
+    adc = convert_deltasigma_recordings(recgen.recordings,
+                                        voltage_ref=voltage_ref,
+                                        resolution=resolution,
+                                        chunk_size=chunk_size,
+                                        order=order,
+                                        osr=osr,
+                                        levels=levels,
+                                        mode=mode,
+                                        segment_length=segment_length,
+                                        warmup=warmup)
+
+    adcgen = {}
+    adcgen["adc"] = adc
+    adcgen["normalized"] = get_normalized(adc, resolution, normalized_dtype)
+    adcgen["adcinfo"] = {
+        "voltage_ref": voltage_ref,
+        "resolution": resolution,
+        "order": order,
+        "osr": osr,
+        "levels": levels,
+        "mode": mode
+    }
+    if segment_length is not None:
+        adcgen["adcinfo"]["segment_length"] = segment_length
+        adcgen["adcinfo"]["warmup"] = warmup
+    adcgen["recordings"] = recgen
+
+    save_converted_adc(adcgen, recfile, output_folder=FOLDER_DELTASIGMA)
+
+    return adcgen
+
+
+def get_lcadc_sweep(recfile=None,
+                    voltage_refs=[1000],
+                    resolutions=[12],
+                    hystereses=[0],
+                    noise_level=None,
+                    fs=None,
+                    verbose=True,
+                    chunk_size=100000):
+    """Convert recordings with every LCADC configuration in one pass.
+
+    All configurations are saved in a single file, see sweep_lcadc for its
+    content.
+    """
+
+    recfile = Path(recfile)
+    recgen = load_recordings(datafolder=recfile,
+                             noise_level=noise_level,
+                             fs=fs,
+                             verbose=verbose)
+
+    sweep = sweep_lcadc(recgen.recordings,
+                        voltage_refs=voltage_refs,
+                        resolutions=resolutions,
+                        hystereses=hystereses,
+                        bipolar=True,
+                        operator=round,
+                        chunk_size=chunk_size)
+
+    noise_level = recgen.info["recordings"]["noise_level"]
+    fs = recgen.info["recordings"]["fs"]
+    sweep["adcinfo"] = {"noise_level": noise_level, "fs": fs}
+
+    filename = str(
+        recfile.parent /
+        FOLDER_LCADC /
+        f'sweep_{len(sweep["resolution"])}configs_'
+        f'{np.round(noise_level, 2)}uV_'
+        f'{int(fs)}Hz_'
+        f'{time.strftime("%Y-%m-%d_%H-%M")}.h5')
+    save_lcadc_sweep(sweep, filename)
+
+    return sweep
+
+
+def save_converted_adc(adcgen, recfile=None, is_lcadc=False,
+                       output_folder=None):
+
+    recgen = adcgen["recordings"]
+    resolution = adcgen["adcinfo"]["resolution"]
     noise_level = recgen.info["recordings"]["noise_level"]
     fs = recgen.info["recordings"]["fs"]
 
     if recfile is not None:
-        parent_dir = recfile.parent
+        parent_dir = Path(recfile).parent
     else:
         parent_dir = default_dir
 
-    if is_lcadc:
-        output_folder = FOLDER_LCADC
-    else:
-        output_folder = FOLDER_ADC
+    if output_folder is None:
+        if is_lcadc:
+            output_folder = FOLDER_LCADC
+        else:
+            output_folder = FOLDER_ADC
 
     filename = str(
         parent_dir /
@@ -95,7 +285,28 @@ def get_converted_adc(recfile=None,
         f'{int(fs)}Hz.h5')
     save_converted_values(adcgen, filename, is_lcadc=is_lcadc)
 
-    return adcgen
+    return filename
+
+
+def get_normalized(converted, resolution, dtype=None):
+    """Get normalized values, lazily computed when dtype is None.
+
+    Lazy normalized values are derived from the codes when accessed and are
+    not saved; otherwise they are computed with the given floating type and
+    saved along with the codes.
+    """
+
+    if isinstance(converted, RaggedArray):
+        # Flat values are normalized at once, channels keep their offsets
+        return converted.map(
+            lambda values: get_normalized(values, resolution, dtype))
+
+    if dtype is None:
+        if isinstance(converted, np.ndarray) and converted.dtype == object:
+            converted = list(converted)
+        return NormalizedCodes(converted, resolution=resolution)
+
+    return normalize_arrays(converted, resolution=resolution, dtype=dtype)
 
 
 def get_neo(
@@ -105,7 +316,11 @@ def get_neo(
         noise_level=None,
         fs=None,
         verbose=None,
-        is_lcadc=False):
+        is_lcadc=False,
+        neo_dtype=None,
+        chunk_size=None,
+        time_aware=False,
+        kind=KIND_ZOH):
 
     adcgen = load_converted_values(adcfile,
                                    resolution=resolution,
@@ -116,10 +331,25 @@ def get_neo(
 
     neogen = adcgen
     neogen["w"] = w
-    neogen["neo"] = [
-        apply_neo_to_dataset(
-            adcgen["normalized"],
-            cw) for cw in w]
+    if is_lcadc and time_aware:
+        # Neighbours w samples away in time, looked up among the events
+        n_samples = len(adcgen["recordings"].timestamps)
+        neogen["neo"] = apply_neo_to_events(adcgen["indexes"],
+                                            adcgen["normalized"], n_samples,
+                                            w, kind=kind)
+    elif is_lcadc:
+        neogen["neo"] = [
+            apply_neo_to_dataset(
+                adcgen["normalized"],
+                cw) for cw in w]
+    elif chunk_size is not None:
+        # Computed chunk by chunk while saved, in constant memory
+        neogen["neo"] = StreamedNEO(adcgen["normalized"], w,
+                                    chunk_size=chunk_size, dtype=neo_dtype)
+    else:
+        # All w at once, with shape (w, channels, samples)
+        neogen["neo"] = apply_neo_to_matrix(adcgen["normalized"], w,
+                                            dtype=neo_dtype)
 
     resolution = adcgen["adcinfo"]["resolution"]
     noise_level = adcgen["recordings"].info["recordings"]["noise_level"]
@@ -148,6 +378,138 @@ def get_neo(
     return neogen
 
 
+def get_preprocessed(recfile=None,
+                     voltage_ref=1000,
+                     resolution=12,
+                     w=[1],
+                     noise_level=None,
+                     fs=None,
+                     verbose=True,
+                     block_size=100000,
+                     normalized_dtype=np.float64,
+                     neo_dtype=None,
+                     keep_adc=True,
+                     keep_normalized=False,
+                     adc_dtype=None):
+    """Convert recordings and apply NEO in one pass, as get_converted_adc
+    and get_neo would do.
+
+    Blocks of recordings are converted, normalized and preprocessed with
+    preprocess_adc_recordings, writing NEO and, if asked, codes and
+    normalized values into the output file as they are computed. Codes are
+    kept by default, so loaded files have normalized values derived lazily
+    from them, as the ones of get_converted_adc, for get_over_threshold.
+    Saved codes have the signed type of get_block_code_dtype unless an
+    adc_dtype is given, unlike the compact codes of get_converted_adc, and
+    recordings more than a whole range beyond the reference raise an
+    AttributeError with it.
+
+    :return: NEO values loaded lazily from the saved file, as load_neo
+    :rtype: dict
+    """
+
+    recfile = Path(recfile)
+    recgen = load_recordings(datafolder=recfile,
+                             noise_level=noise_level,
+                             fs=fs,
+                             verbose=verbose)
+
+    noise_level = recgen.info["recordings"]["noise_level"]
+    fs = recgen.info["recordings"]["fs"]
+    n_samples, n_channels = recgen.recordings.shape
+    neo_dtype = normalized_dtype if neo_dtype is None else neo_dtype
+
+    filename = (
+        recfile.resolve().parent /
+        FOLDER_PREPROCESSOR /
+        f'preprocessed_neo_{resolution}_'
+        f'{np.round(noise_level, 2)}uV_'
+        f'{int(fs)}Hz_'
+        f'{time.strftime("%Y-%m-%d_%H-%M")}.h5')
+    filename.parent.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(filename, 'w') as f:
+        out = {"neo": f.create_dataset('neo',
+                                       shape=(len(w), n_channels, n_samples),
+                                       dtype=neo_dtype)}
+        if keep_adc:
+            if adc_dtype is None:
+                adc_dtype = get_block_code_dtype(resolution)
+            out["adc"] = f.create_dataset('adc',
+                                          shape=(n_channels, n_samples),
+                                          dtype=adc_dtype)
+        if keep_normalized:
+            out["normalized"] = f.create_dataset(
+                'normalized', shape=(n_channels, n_samples),
+                dtype=normalized_dtype)
+
+        prepgen = preprocess_adc_recordings(
+            recgen.recordings,
+            voltage_ref=voltage_ref,
+            resolution=resolution,
+            w=w,
+            block_size=block_size,
+            normalized_dtype=normalized_dtype,
+            neo_dtype=neo_dtype,
+            out=out)
+        prepgen["w"] = w
+        prepgen["adcinfo"] = {
+            "voltage_ref": voltage_ref,
+            "resolution": resolution
+        }
+        prepgen["recordings"] = recgen
+        save_preprocessed_values_to_file(prepgen, f)
+
+    neogen, _ = load_neo(filename, verbose=verbose)
+    return neogen
+
+
+def get_operators(
+        adcfile=None,
+        operators={OPERATOR_NEO: [1]},
+        resolution=None,
+        noise_level=None,
+        fs=None,
+        verbose=None,
+        operator_dtype=None):
+
+    adcgen = load_converted_values(adcfile,
+                                   resolution=resolution,
+                                   noise_level=noise_level,
+                                   fs=fs,
+                                   verbose=verbose)
+    if len(getattr(adcgen.get("normalized"), "shape", ())) != 2:
+        raise AttributeError(f"{adcfile} has no values with shape (channels, "
+                             "samples), LCADC files are not supported")
+
+    opgen = adcgen
+    # All operators in one pass, sharing NEO of the same widths
+    opgen["parameters"] = {name: list(parameters)
+                           for name, parameters in operators.items()}
+    opgen["operators"] = apply_operators(adcgen["normalized"], operators,
+                                         dtype=operator_dtype)
+
+    resolution = adcgen["adcinfo"]["resolution"]
+    noise_level = adcgen["recordings"].info["recordings"]["noise_level"]
+    fs = adcgen["recordings"].info["recordings"]["fs"]
+
+    if adcfile is not None:
+        parent_dir = Path(adcfile).resolve().parent
+    else:
+        parent_dir = default_dir
+
+    filename = str(
+        parent_dir /
+        FOLDER_PREPROCESSOR /
+        f'preprocessed_operators_{resolution}_'
+        f'{np.round(noise_level, 2)}uV_'
+        f'{int(fs)}Hz_'
+        f'{time.strftime("%Y-%m-%d_%H-%M")}.h5')
+
+    save_operator_values(opgen, filename)
+    return opgen
+
+
 def get_over_threshold(
         neofile,
         resolution=None,
@@ -169,13 +531,17 @@ def get_over_threshold(
                             is_lcadc=is_lcadc)
 
     recordings = np.array(neogen["recordings"].recordings[:, :].T)
-    normalized = np.array(neogen["normalized"])
+    # Preprocessed files without codes nor normalized values only have NEO
+    normalized = None
+    if "normalized" in neogen:
+        normalized = np.array(neogen["normalized"])
     neo = neogen["neo"]
     # print(neo)
 
     if ch_indexes is not None:
         recordings = recordings[ch_indexes]
-        normalized = normalized[ch_indexes]
+        if normalized is not None:
+            normalized = normalized[ch_indexes]
         if isinstance(neo, np.ndarray):
             neo = neo[:, ch_indexes]
         else:
@@ -228,29 +594,32 @@ def get_over_threshold(
     save_indexes_and_counts(threcordings, filename_rec)
     del threcordings
 
-    print("Processing normalized")
-    listidx, counts, listidx_spikes,\
-        counts_spikes, ths = evaluate_threshold_maximum(normalized,
-                                                        nthresholds,
-                                                        absolute=absolute_adc)
-    thnorm = {"source_file": str(fneo),
-              "channels": ch_indexes,
-              "indexes": listidx,
-              "counts": counts,
-              "indexes_spikes": listidx_spikes,
-              "counts_spikes": counts_spikes,
-              "thresholds": ths,
-              "count_thresholds": nthresholds}
-
-    print(thnorm)
-    filename_norm = str(
-        parent_dir /
-        output_folder /
-        f'threshold_normalized_{fileid}_{time.strftime("%Y-%m-%d_%H-%M")}.h5')
-
-    save_indexes_and_counts(thnorm, filename_norm,
-                            is_lcadc=is_lcadc)
-    del thnorm
+    if normalized is None:
+        print("No normalized values, skipping them")
+    else:
+        print("Processing normalized")
+        listidx, counts, listidx_spikes,\
+            counts_spikes, ths = evaluate_threshold_maximum(
+                normalized, nthresholds, absolute=absolute_adc)
+        thnorm = {"source_file": str(fneo),
+                  "channels": ch_indexes,
+                  "indexes": listidx,
+                  "counts": counts,
+                  "indexes_spikes": listidx_spikes,
+                  "counts_spikes": counts_spikes,
+                  "thresholds": ths,
+                  "count_thresholds": nthresholds}
+
+        print(thnorm)
+        filename_norm = str(
+            parent_dir /
+            output_folder /
+            f'threshold_normalized_{fileid}_'
+            f'{time.strftime("%Y-%m-%d_%H-%M")}.h5')
+
+        save_indexes_and_counts(thnorm, filename_norm,
+                                is_lcadc=is_lcadc)
+        del thnorm
 
     print("Processing neo array")
     listidx, counts, listidx_spikes, \
@@ -278,6 +647,30 @@ def get_over_threshold(
     return neogen
 
 
+def get_reconstructed_lcadc(neofile, kind=KIND_ZOH, dtype=np.float64):
+    """Rebuild LCADC normalized and NEO values on the timestamps grid.
+
+    The returned dictionary has the same layout as the one of uniformly
+    sampled values, so it can be processed as them.
+    """
+
+    neogen, _ = load_neo(neofile, is_lcadc=True)
+    n_samples = len(neogen["recordings"].timestamps)
+    indexes = [np.array(channel_indexes)
+               for channel_indexes in neogen["indexes"]]
+
+    neogen["normalized"] = reconstruct(
+        indexes, [np.array(values) for values in neogen["normalized"]],
+        n_samples, kind=kind, dtype=dtype)
+    if "neo" in neogen:
+        neogen["neo"] = reconstruct(
+            indexes, [[np.array(values) for values in neo_w]
+                      for neo_w in neogen["neo"]],
+            n_samples, kind=kind, dtype=dtype)
+
+    return neogen
+
+
 def get_spiketrain_list(neofile, is_lcadc=False):
 
     neogen, _ = load_neo(neofile, is_lcadc=is_lcadc)
@@ -421,11 +814,13 @@ if __name__ == "__main__":
     # neogen = getNEO(folder, w=[1, 2, 4, 16])
 
     neofolder = default_dir / FOLDER_PREPROCESSOR
+    # Preprocessed in one pass, codes are kept for normalized values
+    get_preprocessed(default_dir / "recordings", w=[1, 2, 4, 16])
     neogen, fneo = load_neo(neofolder)
     print(neogen)
 
-    # thgen = getOverThreshold(neofolder)
-    # print(thgen)
+    thgen = get_over_threshold(fneo)
+    print(thgen)
 
     evalfolder = default_dir / FOLDER_EVALUATOR
 
@@ -0,0 +1,123 @@
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+from scipy import interpolate
+import numpy as np
+
+from eapprocessor.multi import NUM_CORES, MULTI_ENABLED
+from eapprocessor.tools.fft import fft
+from eapprocessor.tools.metrics import calculate_snr, calculate_enob
+
+# Interpolators of the sweep, set once per worker process
+_interpolators = {}
+
+
+def set_interpolators(interpolators):
+
+    global _interpolators
+    _interpolators = interpolators
+
+
+def fit_interpolators(signals, kinds):
+    """Fit a spline of each order for every (time, values) signal."""
+
+    return {(signal_idx, kind): interpolate.make_interp_spline(time, values,
+                                                               k=kind)
+            for signal_idx, (time, values) in enumerate(signals)
+            for kind in kinds}
+
+
+def evaluate_point(point, keep_spectrum=False):
+
+    signal_idx, fs, kind, t_start, t_stop = point
+    x = np.arange(t_start, t_stop, 1 / fs)
+    y = _interpolators[(signal_idx, kind)](x)
+    xf, yf = fft(y, fs)
+    snr = calculate_snr(yf)
+    spectrum = (xf, yf) if keep_spectrum else None
+    return snr, len(x), spectrum
+
+
+def evaluate_points(points, keep_spectrum=False):
+
+    return [evaluate_point(point, keep_spectrum=keep_spectrum)
+            for point in points]
+
+
+def sweep_snr(signals, fs, kinds, t_start, t_stop,
+              n_workers=NUM_CORES if MULTI_ENABLED else 1,
+              keep_spectra=False):
+    """Characterize SNR and ENOB over a grid of parameters.
+
+    Every signal is interpolated once per spline order, and the splines are
+    shared by all points of the grid: product of signals, fs, kinds,
+    t_start and t_stop. Points are evaluated in a pool of n_workers
+    processes, by default only when MULTI_ENABLED, each receiving the
+    splines once.
+
+    :param signals: list of (time, values) of non-uniformly sampled signals
+    :param fs: sampling frequencies of the uniform grid
+    :param kinds: orders of the interpolating spline
+    :param t_start: start times of the analysed window
+    :param t_stop: stop times of the analysed window
+    :param keep_spectra: also return (xf, yf) of every point
+    :return: dictionary with a numeric array per column: signal, fs, kind,
+        t_start, t_stop, samples, snr and enob, and spectra if requested
+    """
+
+    points = list(itertools.product(range(len(signals)), fs, kinds,
+                                    t_start, t_stop))
+    interpolators = fit_interpolators(signals, kinds)
+
+    n_workers = min(n_workers, len(points))
+    if n_workers > 1:
+        # Contiguous blocks of points per task to limit communication
+        blocks = np.array_split(np.arange(len(points)), n_workers * 4)
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=set_interpolators,
+                                 initargs=(interpolators,)) as pool:
+            futures = [pool.submit(evaluate_points,
+                                   [points[idx] for idx in block],
+                                   keep_spectra)
+                       for block in blocks if len(block) > 0]
+            evaluated = [item for future in futures
+                         for item in future.result()]
+    else:
+        set_interpolators(interpolators)
+        evaluated = evaluate_points(points, keep_spectrum=keep_spectra)
+
+    columns = np.array(points, dtype=np.float64).reshape(-1, 5)
+    snr = np.array([item[0] for item in evaluated], dtype=np.float64)
+    results = {
+        "signal": columns[:, 0].astype(int),
+        "fs": columns[:, 1],
+        "kind": columns[:, 2].astype(int),
+        "t_start": columns[:, 3],
+        "t_stop": columns[:, 4],
+        "samples": np.array([item[1] for item in evaluated], dtype=int),
+        "snr": snr,
+        "enob": calculate_enob(snr),
+    }
+    if keep_spectra:
+        results["spectra"] = [item[2] for item in evaluated]
+
+    return results
+
+
+if __name__ == "__main__":
+
+    import time
+
+    # Level crossing samples of a sine wave
+    rng = np.random.default_rng(0)
+    t = np.sort(rng.uniform(0, 0.01, 5000))
+    values = np.round(np.sin(2 * np.pi * 1e3 * t) * 2**7) / 2**7
+
+    start = time.perf_counter()
+    results = sweep_snr([(t, values)], fs=[20e3 * 32, 20e3 * 64],
+                        kinds=[1, 2, 3], t_start=[0.001, 0.002],
+                        t_stop=[0.008, 0.009])
+    elapsed = time.perf_counter() - start
+    print(f"{len(results['snr'])} points in {elapsed:.3f} s")
+    for kind in [1, 2, 3]:
+        selected = results["kind"] == kind
+        print(f"Order {kind}: ENOB {results['enob'][selected].mean():.2f}")
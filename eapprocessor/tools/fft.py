@@ -1,12 +1,23 @@
-from scipy.fft import fft as sci_fft, fftfreq
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scipy.fft import fft as sci_fft, fftfreq, rfft, rfftfreq
+from scipy.signal import get_window
+import h5py
 import numpy as np
 
+from eapprocessor.multi import NUM_CORES, MULTI_ENABLED
 
-def fft(array, fs, only_positive=True, absolute=True):
 
+def fft(array, fs, only_positive=True, absolute=True, window=None):
+
+    # Spectra of every row at once for arrays of (channels, samples)
+    array = np.asarray(array)
     T = 1.0 / fs
-    N = len(array)
-    yf = sci_fft(array)
+    N = array.shape[-1]
+    if window is not None:
+        # Coherent gain is compensated, so tone amplitudes are kept
+        taper = get_window(window, N)
+        array = array * (taper / taper.mean())
+    yf = sci_fft(array, axis=-1)
     xf = fftfreq(N, T)
 
     if (absolute):
@@ -14,6 +25,152 @@ def fft(array, fs, only_positive=True, absolute=True):
 
     if (only_positive):
         xf = xf[0:N // 2]
-        yf = 2.0 / N * (yf[0:N // 2])
+        yf = 2.0 / N * (yf[..., 0:N // 2])
 
     return xf, yf
+
+
+def get_welch_segments(n_samples, nperseg, noverlap):
+
+    step = nperseg - noverlap
+    if n_samples < nperseg:
+        return 0, step
+    return (n_samples - nperseg) // step + 1, step
+
+
+def sum_periodograms(dataset, first_segment, last_segment, nperseg, step,
+                     taper, dtype=np.float32):
+    """Sum periodograms of all channels over a range of Welch segments.
+
+    Segments are read as one block of dataset, with shape (samples,
+    channels), so they overlap in memory instead of being copied.
+    """
+
+    start = first_segment * step
+    stop = (last_segment - 1) * step + nperseg
+    block = np.asarray(dataset[start:stop], dtype=dtype)
+    if block.ndim == 1:
+        block = block.reshape(-1, 1)
+
+    segments = np.lib.stride_tricks.sliding_window_view(
+        block.T, nperseg, axis=-1)[:, ::step]
+    segments = segments - segments.mean(axis=-1, keepdims=True)
+    segments *= taper
+    spectra = np.abs(rfft(segments, axis=-1))**2
+    return spectra.sum(axis=1, dtype=np.float64)
+
+
+def sum_welch_range(dataset, first_segment, last_segment, nperseg, step,
+                    taper, segments_per_chunk=64, dtype=np.float32,
+                    n_workers=1):
+
+    chunks = [(first, min(first + segments_per_chunk, last_segment))
+              for first in range(first_segment, last_segment,
+                                 segments_per_chunk)]
+
+    def sum_chunk(chunk):
+        return sum_periodograms(dataset, chunk[0], chunk[1], nperseg, step,
+                                taper, dtype=dtype)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            return sum(pool.map(sum_chunk, chunks))
+    return sum(sum_chunk(chunk) for chunk in chunks)
+
+
+def scale_density(total, n_segments, fs, taper, nperseg):
+
+    density = total / n_segments / (fs * np.sum(taper.astype(np.float64)**2))
+    # One-sided, DC and Nyquist are not folded
+    if nperseg % 2:
+        density[:, 1:] *= 2
+    else:
+        density[:, 1:-1] *= 2
+    return density
+
+
+def welch(dataset, fs, nperseg=1024, noverlap=None, window="hann",
+          segments_per_chunk=64, dtype=np.float32,
+          n_workers=NUM_CORES if MULTI_ENABLED else 1):
+    """Estimate power spectral density of every channel with Welch method.
+
+    Dataset is read in chunks of segments_per_chunk segments, so it may be
+    an HDF5 dataset of a long recording, e.g. recgen.recordings. Chunks are
+    processed by a pool of n_workers threads, by default only when
+    MULTI_ENABLED; the FFT releases the GIL.
+    Constant detrending and density scaling are the ones of
+    scipy.signal.welch.
+
+    :param dataset: recordings with shape (samples, channels) or (samples,)
+    :param dtype: floating type to compute periodograms, float32 by default
+    :return: frequencies and densities with shape (channels, frequencies)
+    """
+
+    if noverlap is None:
+        noverlap = nperseg // 2
+    n_segments, step = get_welch_segments(dataset.shape[0], nperseg,
+                                          noverlap)
+    if n_segments == 0:
+        raise AttributeError(f"Dataset has less than {nperseg} samples")
+
+    taper = get_window(window, nperseg).astype(dtype)
+    total = sum_welch_range(dataset, 0, n_segments, nperseg, step, taper,
+                            segments_per_chunk=segments_per_chunk,
+                            dtype=dtype, n_workers=n_workers)
+    density = scale_density(total, n_segments, fs, taper, nperseg)
+    return rfftfreq(nperseg, 1.0 / fs), density.astype(dtype)
+
+
+def welch_file(filename, fs=None, path="recordings", nperseg=1024,
+               noverlap=None, window="hann", segments_per_chunk=64,
+               dtype=np.float32,
+               n_workers=NUM_CORES if MULTI_ENABLED else 1):
+    """Estimate power spectral density of a dataset of an HDF5 file.
+
+    Segments are split in n_workers ranges, each one processed by a worker
+    process that opens the file and reads its range chunk by chunk. By
+    default a pool is only used when MULTI_ENABLED.
+
+    :param fs: sampling frequency, read from info of MEArec files if None
+    :return: frequencies and densities with shape (channels, frequencies)
+    """
+
+    with h5py.File(str(filename), 'r') as f:
+        if fs is None:
+            fs = float(f['info/recordings/fs'][()])
+        n_samples = f[path].shape[0]
+
+    if noverlap is None:
+        noverlap = nperseg // 2
+    n_segments, step = get_welch_segments(n_samples, nperseg, noverlap)
+    if n_segments == 0:
+        raise AttributeError(f"Dataset has less than {nperseg} samples")
+
+    taper = get_window(window, nperseg).astype(dtype)
+    bounds = np.linspace(0, n_segments, max(n_workers, 1) + 1).astype(int)
+    ranges = [(first, last) for first, last in zip(bounds[:-1], bounds[1:])
+              if last > first]
+    arguments = (str(filename), path, nperseg, step, taper,
+                 segments_per_chunk, dtype)
+
+    if len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [pool.submit(sum_welch_file_range, first, last,
+                                   *arguments)
+                       for first, last in ranges]
+            total = sum(future.result() for future in futures)
+    else:
+        total = sum_welch_file_range(0, n_segments, *arguments)
+
+    density = scale_density(total, n_segments, fs, taper, nperseg)
+    return rfftfreq(nperseg, 1.0 / fs), density.astype(dtype)
+
+
+def sum_welch_file_range(first_segment, last_segment, filename, path,
+                         nperseg, step, taper, segments_per_chunk, dtype):
+
+    with h5py.File(filename, 'r') as f:
+        return sum_welch_range(f[path], first_segment, last_segment,
+                               nperseg, step, taper,
+                               segments_per_chunk=segments_per_chunk,
+                               dtype=dtype)
@@ -20,14 +20,19 @@ def project_values_array_to_indexes_array(original_indexes,
                                           values_array,
                                           indexes_array,
                                           default=0):
-    arr = []
+    arr = None
     for idx, values in enumerate(values_array):
-        arr += [project_values_array_to_indexes(original_indexes,
-                                                values,
-                                                indexes_array[idx],
-                                                default=default)]
+        projected = project_values_array_to_indexes(original_indexes,
+                                                    values,
+                                                    indexes_array[idx],
+                                                    default=default)
+        if arr is None:
+            arr = np.empty((len(values_array),) + projected.shape)
+        arr[idx] = projected
 
-    return np.array(arr)
+    if arr is None:
+        return np.array([])
+    return arr
 
 
 def project_values_array_to_indexes(original_indexes,
@@ -35,9 +40,10 @@ def project_values_array_to_indexes(original_indexes,
                                     indexes,
                                     default=0):
 
-    dataset_values = np.array(dataset_values)
-    indexes = np.array(indexes)
-    base = np.ones((len(dataset_values), len(original_indexes))) * default
+    dataset_values = np.asarray(dataset_values)
+    indexes = np.asarray(indexes, dtype=np.int64)
+    base = np.full((len(dataset_values), len(original_indexes)), default,
+                   dtype=np.float64)
 
     base[:, indexes] = dataset_values
 
@@ -46,10 +52,10 @@ def project_values_array_to_indexes(original_indexes,
 
 def project_to_indexes(original_indexes, values, indexes, default=0):
 
-    original_indexes = np.array(original_indexes)
-    values = np.array(values)
-    indexes = np.array(indexes)
-    base = np.ones(original_indexes.shape) * default
+    original_indexes = np.asarray(original_indexes)
+    values = np.asarray(values)
+    indexes = np.asarray(indexes, dtype=np.int64)
+    base = np.full(original_indexes.shape, default, dtype=np.float64)
 
     base[indexes] = values
 
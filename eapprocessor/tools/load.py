@@ -1,9 +1,12 @@
 # /bin/python3
 
 from pathlib import Path
+import json
 import h5py
 import MEArec as mr
 import numpy as np
+from eapprocessor.hwsimulator.adc import NormalizedCodes
+from eapprocessor.tools.ragged import RaggedArray
 
 
 def find_hdf5_file_from_folder(path,
@@ -101,17 +104,21 @@ def load_converted_values_from_file(f, path='', is_lcadc=False):
         if f.get(path + 'channels') is not None:
             adc_dict["channels"] = f.get(path + 'channels')
 
-            channels = np.array(adc_dict["channels"])
-            lcadc = []
-            indexes = []
-            normalized = []
-            for channel in channels:
-                if f.get(path + 'lcadc/' + str(channel)) is not None:
-                    lcadc += [f.get(path + 'lcadc/' + str(channel))]
-                if f.get(path + 'indexes/' + str(channel)) is not None:
-                    indexes += [f.get(path + 'indexes/' + str(channel))]
-                if f.get(path + 'normalized/' + str(channel)) is not None:
-                    normalized += [f.get(path + 'normalized/' + str(channel))]
+            if f.get(path + 'offsets') is not None:
+                offsets = f[path + 'offsets'][()]
+                lcadc = RaggedArray(f[path + 'lcadc'][()], offsets)
+                indexes = RaggedArray(f[path + 'indexes'][()], offsets)
+                normalized = None
+                if f.get(path + 'normalized') is not None:
+                    normalized = RaggedArray(f[path + 'normalized'][()],
+                                             offsets)
+            else:
+                lcadc, indexes, normalized = \
+                    load_lcadc_channels_from_file(f, path=path)
+
+            if normalized is None:
+                normalized = lcadc.map(lambda values: NormalizedCodes(
+                    values, resolution=adc_dict["adcinfo"]["resolution"]))
 
             adc_dict["lcadc"] = lcadc
             adc_dict["indexes"] = indexes
@@ -126,6 +133,9 @@ def load_converted_values_from_file(f, path='', is_lcadc=False):
 
         if f.get(path + 'normalized') is not None:
             adc_dict["normalized"] = f.get(path + 'normalized')
+        elif "adc" in adc_dict:
+            adc_dict["normalized"] = NormalizedCodes(
+                adc_dict["adc"], resolution=adc_dict["adcinfo"]["resolution"])
 
     rec_dict, info = mr.load_recordings_from_file(f, path=path + 'recordings/')
     recgen = mr.RecordingGenerator(rec_dict=rec_dict, info=info)
@@ -134,6 +144,60 @@ def load_converted_values_from_file(f, path='', is_lcadc=False):
     return adc_dict
 
 
+def load_lcadc_channels_from_file(f, path=''):
+
+    # Files saved with a dataset per channel
+    channels = np.array(f.get(path + 'channels'))
+    lcadc = []
+    indexes = []
+    normalized = []
+    for channel in channels:
+        lcadc += [get_channel_values(f, path + 'lcadc/' + str(channel))]
+        indexes += [get_channel_values(f, path + 'indexes/' + str(channel))]
+        if f.get(path + 'normalized/' + str(channel)) is not None:
+            normalized += [f[path + 'normalized/' + str(channel)][()]]
+
+    lcadc = RaggedArray.from_arrays(lcadc)
+    indexes = RaggedArray(RaggedArray.from_arrays(indexes).values,
+                          lcadc.offsets)
+    if len(normalized) == len(channels) and len(channels) > 0:
+        normalized = RaggedArray(RaggedArray.from_arrays(normalized).values,
+                                 lcadc.offsets)
+    else:
+        normalized = None
+
+    return lcadc, indexes, normalized
+
+
+def get_channel_values(f, path):
+
+    if f.get(path) is None:
+        return np.array([])
+    return f[path][()]
+
+
+def load_lcadc_sweep(filename):
+
+    with h5py.File(str(filename), 'r') as f:
+        return load_lcadc_sweep_from_file(f)
+
+
+def load_lcadc_sweep_from_file(f, path=''):
+
+    sweep = {}
+    for key in ["voltage_ref", "resolution", "hysteresis"]:
+        sweep[key] = f[path + 'configurations/' + key][()]
+    sweep["channels"] = f[path + 'channels'][()]
+    sweep["counts"] = f[path + 'counts'][()]
+    offsets = f[path + 'offsets'][()]
+    sweep["lcadc"] = RaggedArray(f[path + 'lcadc'][()], offsets)
+    sweep["indexes"] = RaggedArray(f[path + 'indexes'][()], offsets)
+    if f.get(path + 'adcinfo') is not None:
+        sweep["adcinfo"] = mr.load_dict_from_hdf5(f, path + 'adcinfo/')
+
+    return sweep
+
+
 def load_neo(filename=None,
              resolution=None,
              noise_level=None,
@@ -179,16 +243,17 @@ def load_neo_from_file(f, is_lcadc=False, path=''):
 
     if is_lcadc:
         channels = np.array(neo_dict["channels"])
+        offsets = neo_dict["lcadc"].offsets
         neo = []
 
         for neo_id, _ in enumerate(neo_dict["w"]):
-            neo_w = []
-            for channel in channels:
-                if f.get(path + 'neo/' +
-                         str(neo_id) + "/" + str(channel)) is not None:
-                    neo_w += [f.get(path + 'neo/' +
-                                    str(neo_id) + "/" + str(channel))]
-            neo += [neo_w]
+            neo_path = path + 'neo/' + str(neo_id)
+            if isinstance(f.get(neo_path), h5py.Dataset):
+                neo += [RaggedArray(f[neo_path][()], offsets)]
+            else:
+                neo += [RaggedArray(RaggedArray.from_arrays([
+                    get_channel_values(f, neo_path + "/" + str(channel))
+                    for channel in channels]).values, offsets)]
 
         neo_dict["neo"] = neo
 
@@ -200,6 +265,37 @@ def load_neo_from_file(f, is_lcadc=False, path=''):
     return neo_dict
 
 
+def load_operators(filename=None, verbose=True):
+
+    filename = Path(filename).resolve()
+    if filename.is_dir():
+        filename = find_hdf5_file_from_folder(filename,
+                                              pattern="*operators*",
+                                              verbose=verbose)
+
+    if filename.suffix in ['.h5', '.hdf5']:
+        file = h5py.File(str(filename), 'r')
+        op_dict = load_operators_from_file(file)
+    else:
+        raise Exception("Operator values must be an hdf5 file (.h5 or .hdf5)")
+
+    return op_dict, filename
+
+
+def load_operators_from_file(f, path=''):
+
+    op_dict = load_converted_values_from_file(f, path=path)
+    op_dict["operators"] = {}
+    op_dict["parameters"] = {}
+    if f.get(path + 'operators') is not None:
+        for name, dataset in f[path + 'operators'].items():
+            op_dict["operators"][name] = dataset
+            op_dict["parameters"][name] = json.loads(
+                dataset.attrs["parameters"])
+
+    return op_dict
+
+
 def build_pattern(resolution=None,
                   noise_level=None,
                   fs=None,
@@ -1,5 +1,16 @@
 import numpy as np
 
+# Bins at each side of a tone where a window spreads its power
+WINDOW_LEAKAGE_BINS = {
+    None: 0,
+    "boxcar": 0,
+    "hann": 2,
+    "hamming": 2,
+    "blackman": 3,
+    "blackmanharris": 4,
+    "flattop": 5,
+}
+
 
 def calculate_snr(yf):
     peak_index = np.argmax(yf)
@@ -11,3 +22,121 @@ def calculate_snr(yf):
 
 def calculate_enob(snr):
     return (snr - 1.76) / 6.02
+
+
+def get_leakage_bins(window=None):
+
+    if isinstance(window, tuple):
+        window = window[0]
+    if window not in WINDOW_LEAKAGE_BINS:
+        raise AttributeError(f"Unknown leakage of window {window}")
+    return WINDOW_LEAKAGE_BINS[window]
+
+
+def get_harmonic_bins(fundamental, n_bins, n_harmonics=5):
+    """Get bins of harmonics 2 to n_harmonics + 1, folded in the spectrum.
+
+    :param fundamental: bin of the fundamental of each spectrum
+    :param n_bins: bins of the positive half of the spectrum
+    :return: bins with shape (spectra, n_harmonics)
+    """
+
+    orders = np.arange(2, n_harmonics + 2)
+    bins = (fundamental.reshape(-1, 1) * orders) % (2 * n_bins)
+    return np.where(bins > n_bins, 2 * n_bins - bins, bins)
+
+
+def calculate_dynamic_metrics(yf, window=None, n_harmonics=5):
+    """Get dynamic metrics of single tone spectra of many channels at once.
+
+    Spectra are the amplitudes of the positive frequencies as returned by
+    tools.fft.fft, the same window given there must be given here. Power of
+    a tone is summed over its bin and the bins the window leaks it into.
+    DC, the fundamental (largest bin out of DC) and its harmonics are
+    removed to find the noise; the noise in removed bins is estimated with
+    the mean of the others. Without window nor harmonics, sinad is the
+    value of calculate_snr.
+
+    :param yf: amplitude spectra with shape (..., bins)
+    :param window: window applied before the fft
+    :param n_harmonics: harmonics included in thd, from the second one
+    :return: dictionary of arrays with shape (...): fundamental bin,
+        sinad, snr, thd and sfdr in dB, noise floor as mean power per bin
+        in dB, and enob from sinad
+    """
+
+    yf = np.asarray(yf, dtype=np.float64)
+    shape = yf.shape[:-1]
+    power = yf.reshape(-1, yf.shape[-1])**2
+    n_spectra, n_bins = power.shape
+    span = get_leakage_bins(window)
+    rows = np.arange(n_spectra).reshape(-1, 1)
+    offsets = np.arange(-span, span + 1)
+
+    excluded = np.zeros(power.shape, dtype=bool)
+    excluded[:, :span + 1] = True
+    fundamental = np.argmax(np.where(excluded, -np.inf, power), axis=-1)
+
+    signal_bins = np.clip(fundamental.reshape(-1, 1) + offsets, 0,
+                          n_bins - 1)
+    signal_mask = np.zeros(power.shape, dtype=bool)
+    signal_mask[rows, signal_bins] = True
+    signal_mask &= ~excluded
+    pw_signal = np.sum(power, axis=-1, where=signal_mask)
+    excluded |= signal_mask
+
+    harmonic_centers = get_harmonic_bins(fundamental, n_bins,
+                                         n_harmonics=n_harmonics)
+    harmonic_bins = np.clip(harmonic_centers[:, :, None] + offsets, 0,
+                            n_bins - 1).reshape(n_spectra, -1)
+    harmonic_mask = np.zeros(power.shape, dtype=bool)
+    harmonic_mask[rows, harmonic_bins] = True
+    harmonic_mask &= ~excluded
+    pw_harmonics = np.sum(power, axis=-1, where=harmonic_mask)
+
+    pw_distortion = np.sum(power, axis=-1, where=~excluded)
+    noise_mask = ~(excluded | harmonic_mask)
+    n_noise = np.maximum(np.count_nonzero(noise_mask, axis=-1), 1)
+    noise_floor = np.sum(power, axis=-1, where=noise_mask) / n_noise
+    pw_noise = noise_floor * np.count_nonzero(~excluded, axis=-1)
+
+    pw_peak = power[np.arange(n_spectra), fundamental]
+    pw_spur = np.max(power, axis=-1, where=~excluded, initial=0)
+
+    with np.errstate(divide='ignore'):
+        sinad = 10 * np.log10(pw_signal / pw_distortion)
+        metrics = {
+            "fundamental": fundamental,
+            "sinad": sinad,
+            "snr": 10 * np.log10(pw_signal / pw_noise),
+            "thd": 10 * np.log10(pw_harmonics / pw_signal),
+            "sfdr": 10 * np.log10(pw_peak / pw_spur),
+            "noise_floor": 10 * np.log10(noise_floor),
+            "enob": calculate_enob(sinad),
+        }
+
+    return {key: value.reshape(shape) for key, value in metrics.items()}
+
+
+if __name__ == "__main__":
+
+    from eapprocessor.tools.fft import fft
+
+    fs = 20e3
+    n_samples = 4096
+    t = np.arange(n_samples) / fs
+    rng = np.random.default_rng(0)
+    tone = np.sin(2 * np.pi * 1e3 * t) + 0.01 * np.sin(2 * np.pi * 3e3 * t)
+    channels = np.round((tone + 1e-3 * rng.standard_normal((8, n_samples)))
+                        * 2**9) / 2**9
+
+    _, yf = fft(channels, fs)
+    metrics = calculate_dynamic_metrics(yf)
+    print("Equal to calculate_snr:",
+          np.allclose(calculate_dynamic_metrics(yf, n_harmonics=0)["sinad"],
+                      [calculate_snr(spectrum) for spectrum in yf]))
+
+    _, yf = fft(channels, fs, window="blackmanharris")
+    metrics = calculate_dynamic_metrics(yf, window="blackmanharris")
+    for key in ["sinad", "snr", "thd", "sfdr", "noise_floor", "enob"]:
+        print(f"{key}: {metrics[key].mean():.2f}")
@@ -0,0 +1,91 @@
+import numpy as np
+
+
+class RaggedArray:
+    """Channels of different lengths stored in a single flat array.
+
+    Values of channel c are values[offsets[c]:offsets[c + 1]], so accessing
+    a channel is a slice of the flat array and no copy is made. Arrays of
+    the same channels, e.g. LCADC codes and indexes, share the offsets.
+
+    :param values: flat values of all channels, one after another
+    :param offsets: start of each channel plus the total length, with
+        length channels + 1
+    """
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=None):
+        """Build a ragged array from a list of arrays per channel."""
+
+        arrays = [np.asarray(array) for array in arrays]
+        lengths = [len(array) for array in arrays]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Empty channels do not change the type of values
+        filled = [array for array in arrays if len(array) > 0]
+        if len(filled) == 0:
+            values = np.array([], dtype=dtype)
+        else:
+            values = np.concatenate(filled)
+            if dtype is not None:
+                values = values.astype(dtype, copy=False)
+        return cls(values, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def map(self, function):
+        """Apply function to the flat values keeping the channels."""
+
+        return RaggedArray(function(self.values), self.offsets)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            return self.values[self.offsets[key]:self.offsets[key + 1]]
+
+        if isinstance(key, slice) and key.step in (None, 1):
+            # Consecutive channels are a view of the flat values
+            start, stop, _ = key.indices(len(self))
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return RaggedArray(self.values[offsets[0]:offsets[-1]],
+                               offsets - offsets[0])
+
+        selected = np.arange(len(self))[key]
+        return RaggedArray.from_arrays([self[int(idx)] for idx in selected])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __array__(self, dtype=None, copy=None):
+        rows = list(self)
+        if len(set(self.lengths.tolist())) <= 1:
+            array = np.array(rows)
+        else:
+            array = np.empty(len(rows), dtype=object)
+            array[:] = rows
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
+
+
+if __name__ == "__main__":
+
+    ragged = RaggedArray.from_arrays([np.arange(3), [], np.arange(5)])
+    print(ragged.values, ragged.offsets)
+    print(list(ragged))
+    print(np.shares_memory(ragged[2], ragged.values))
+    print(list(ragged[[0, 2]]))
+    print(list(ragged[1:]))
+    print(list(ragged.map(lambda values: values * 2)))
@@ -0,0 +1,166 @@
+from scipy import interpolate
+import numpy as np
+
+KIND_ZOH = "zoh"
+KIND_LINEAR = "linear"
+KIND_SPLINE = "spline"
+
+
+def get_boundary_events(indexes_list, values_list, n_samples, default=0):
+    """Flatten events of all channels on a single grid of channels * samples.
+
+    Channels are placed one after another, so event index i of channel c is
+    at c * n_samples + i. Events are added at the first and last sample of
+    channels that do not have them, holding the nearest value, or default
+    for channels without events, so each channel is independent.
+    """
+
+    positions = []
+    values = []
+    for channel, (indexes, channel_values) in enumerate(zip(indexes_list,
+                                                            values_list)):
+        indexes = np.asarray(indexes, dtype=np.int64)
+        channel_values = np.asarray(channel_values, dtype=np.float64)
+        offset = channel * n_samples
+        if len(indexes) == 0:
+            positions += [np.array([offset, offset + n_samples - 1])]
+            values += [np.array([default, default], dtype=np.float64)]
+            continue
+
+        if indexes[0] > 0:
+            indexes = np.concatenate(([0], indexes))
+            channel_values = np.concatenate((channel_values[:1],
+                                             channel_values))
+        if indexes[-1] < n_samples - 1:
+            indexes = np.concatenate((indexes, [n_samples - 1]))
+            channel_values = np.concatenate((channel_values,
+                                             channel_values[-1:]))
+        positions += [indexes + offset]
+        values += [channel_values]
+
+    return np.concatenate(positions), np.concatenate(values)
+
+
+def reconstruct_zoh(indexes_list, values_list, n_samples, default=0,
+                    dtype=np.float64):
+    """Rebuild channels on the sample grid holding the latest event value.
+
+    :return: array with shape (channels, samples)
+    """
+
+    n_channels = len(indexes_list)
+    if n_channels == 0:
+        return np.zeros((0, n_samples), dtype=dtype)
+
+    positions, values = get_boundary_events(indexes_list, values_list,
+                                            n_samples, default=default)
+    lengths = np.diff(np.append(positions, n_channels * n_samples))
+    return np.repeat(values.astype(dtype), lengths).reshape(n_channels,
+                                                            n_samples)
+
+
+def reconstruct_linear(indexes_list, values_list, n_samples, default=0,
+                       dtype=np.float64):
+    """Rebuild channels on the sample grid interpolating events linearly.
+
+    :return: array with shape (channels, samples)
+    """
+
+    n_channels = len(indexes_list)
+    if n_channels == 0:
+        return np.zeros((0, n_samples), dtype=dtype)
+
+    positions, values = get_boundary_events(indexes_list, values_list,
+                                            n_samples, default=default)
+    grid = np.arange(n_channels * n_samples)
+    return np.interp(grid, positions, values).astype(dtype).reshape(
+        n_channels, n_samples)
+
+
+def reconstruct_spline(indexes_list, values_list, n_samples, default=0,
+                       dtype=np.float64, k=3):
+    """Rebuild channels on the sample grid with an interpolating spline.
+
+    Channels with less than k + 1 events are interpolated linearly. Values
+    are held before the first and after the last event.
+
+    :return: array with shape (channels, samples)
+    """
+
+    reconstructed = reconstruct_linear(indexes_list, values_list, n_samples,
+                                       default=default, dtype=dtype)
+    for channel, (indexes, values) in enumerate(zip(indexes_list,
+                                                    values_list)):
+        indexes = np.asarray(indexes)
+        if len(indexes) < k + 1:
+            continue
+        spline = interpolate.make_interp_spline(indexes,
+                                                np.asarray(values,
+                                                           dtype=np.float64),
+                                                k=k)
+        inside = slice(indexes[0], indexes[-1] + 1)
+        reconstructed[channel, inside] = spline(
+            np.arange(indexes[0], indexes[-1] + 1))
+
+    return reconstructed
+
+
+RECONSTRUCTORS = {
+    KIND_ZOH: reconstruct_zoh,
+    KIND_LINEAR: reconstruct_linear,
+    KIND_SPLINE: reconstruct_spline,
+}
+
+
+def reconstruct(indexes_list, values, n_samples, kind=KIND_ZOH, default=0,
+                dtype=np.float64):
+    """Rebuild LCADC values on the original sample grid.
+
+    Values may be given per channel, e.g. lcadc or normalized values, or per
+    w and channel, e.g. neo values, sharing indexes of each channel.
+
+    :param indexes_list: event indexes of each channel
+    :param values: values per channel, or per w and channel
+    :param n_samples: samples of the original grid
+    :param kind: KIND_ZOH, KIND_LINEAR or KIND_SPLINE
+    :param default: value of channels without events
+    :param dtype: floating type of the output
+    :return: array with shape (channels, samples) or (w, channels, samples)
+    """
+
+    if kind not in RECONSTRUCTORS:
+        raise AttributeError(f"Unknown reconstruction {kind}")
+    reconstructor = RECONSTRUCTORS[kind]
+
+    if is_nested(values, indexes_list):
+        reconstructed = np.empty((len(values), len(indexes_list), n_samples),
+                                 dtype=dtype)
+        for w_idx, w_values in enumerate(values):
+            reconstructed[w_idx] = reconstructor(indexes_list, w_values,
+                                                 n_samples, default=default,
+                                                 dtype=dtype)
+        return reconstructed
+
+    return reconstructor(indexes_list, values, n_samples, default=default,
+                         dtype=dtype)
+
+
+def is_nested(values, indexes_list):
+    """Check if values are given per w and channel."""
+
+    if len(values) == 0 or len(indexes_list) == 0:
+        return False
+    first = values[0]
+    if not hasattr(first, '__len__') or len(first) == 0:
+        return False
+    return np.ndim(first[0]) > 0
+
+
+if __name__ == "__main__":
+
+    indexes = [[0, 3, 4, 9], [0, 5]]
+    values = [[0, 1, 2, 0], [1, 3]]
+
+    print(reconstruct(indexes, values, 12, kind=KIND_ZOH))
+    print(reconstruct(indexes, values, 12, kind=KIND_LINEAR))
+    print(reconstruct(indexes, [values, values], 12, kind=KIND_LINEAR).shape)
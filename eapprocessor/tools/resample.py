@@ -1,7 +1,11 @@
+from fractions import Fraction
 from scipy import interpolate
 from scipy import signal
 import numpy as np
 
+DEFAULT_MAX_FACTOR = 16
+DEFAULT_CHUNK_SIZE = 2**18
+
 
 def resample(x, y, X_new, kind):
     f = interpolate.make_interp_spline(x, y, k=kind)
@@ -12,3 +16,204 @@ def decimate(x, y, factor):
     y_new = signal.decimate(y, factor)
     x_new = np.linspace(x[0], x[-1], int(len(x) / factor), endpoint=False)
     return x_new, y_new
+
+
+def split_factor(factor, max_factor=DEFAULT_MAX_FACTOR):
+    """Split an integer factor in stages of at most max_factor.
+
+    Prime factors are grouped from the largest one, so 128 with max_factor
+    16 gives [16, 8]. Primes larger than max_factor are a stage alone.
+    """
+
+    primes = []
+    remaining = int(factor)
+    prime = 2
+    while prime * prime <= remaining:
+        while remaining % prime == 0:
+            primes += [prime]
+            remaining //= prime
+        prime += 1
+    if remaining > 1:
+        primes += [remaining]
+
+    stages = []
+    for prime in sorted(primes, reverse=True):
+        for idx, stage in enumerate(stages):
+            if stage * prime <= max_factor:
+                stages[idx] *= prime
+                break
+        else:
+            stages += [prime]
+
+    return sorted(stages, reverse=True)
+
+
+def plan_resampling(fs, fs_new, max_factor=DEFAULT_MAX_FACTOR,
+                    max_denominator=1000):
+    """Plan stages of rational resampling from fs to fs_new.
+
+    The ratio fs_new / fs is approximated by up / down and both are split
+    with split_factor. Every stage decimates as much as possible while the
+    rate stays at least min(fs, fs_new), so no stage filters out the band
+    of the output; otherwise it interpolates by the largest factor left,
+    paired with the largest decimation keeping that bound.
+
+    :return: list of (up, down) factors of each stage
+    """
+
+    ratio = Fraction(fs_new / fs).limit_denominator(max_denominator)
+    downs = split_factor(ratio.denominator, max_factor=max_factor)
+    ups = split_factor(ratio.numerator, max_factor=max_factor)
+    bound = min(ratio, 1)
+
+    stages = []
+    rate = Fraction(1)
+    while len(ups) > 0 or len(downs) > 0:
+        up = 1
+        allowed = [down for down in downs if rate / down >= bound]
+        if len(allowed) == 0:
+            up = ups.pop(0)
+            allowed = [down for down in downs
+                       if rate * up / down >= bound]
+        down = max(allowed, default=1)
+        if down > 1:
+            downs.remove(down)
+        rate = rate * up / down
+        stages += [(up, down)]
+
+    return stages
+
+
+def get_stage_filter(up, down, dtype=np.float64):
+    """Get the anti-aliasing filter of a stage, as signal.resample_poly.
+
+    The filter is zero padded so its center is delayed a whole number of
+    output samples, which is also returned.
+    """
+
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = signal.firwin(2 * half_len + 1, 1. / max_rate,
+                      window=('kaiser', 5.0)) * up
+    n_pre_pad = down - half_len % down
+    h = np.concatenate((np.zeros(n_pre_pad), h)).astype(dtype)
+    return h, (half_len + n_pre_pad) // down
+
+
+def resample_poly_chunked(matrix, up, down, chunk_size=DEFAULT_CHUNK_SIZE,
+                          dtype=np.float64):
+    """Resample channels by up / down with a polyphase filter, in chunks.
+
+    Each chunk of output samples is computed from the input samples it
+    needs, overlapping the neighbouring chunks by the filter length, so the
+    result is the one of signal.resample_poly over the whole signal.
+    Input is only read chunk by chunk, e.g. from an HDF5 dataset.
+
+    :param matrix: values with shape (channels, samples) or (samples,)
+    :return: resampled values with shape (channels, ceil(samples * up /
+        down)) or (samples,)
+    """
+
+    common = np.gcd(up, down)
+    up, down = up // common, down // common
+    if up == down == 1:
+        return np.array(matrix, dtype=dtype)
+
+    one_dimension = len(matrix.shape) == 1
+    n_samples = matrix.shape[-1]
+    n_channels = 1 if one_dimension else matrix.shape[0]
+    n_out = -(-n_samples * up // down)
+    h, delay = get_stage_filter(up, down, dtype=dtype)
+    resampled = np.empty((n_channels, n_out), dtype=dtype)
+
+    # Chunks of output are aligned with input samples multiple of down
+    out_chunk = max(chunk_size // max(down, 1), 1) * up
+    for out_start in range(0, n_out, out_chunk):
+        out_stop = min(out_start + out_chunk, n_out)
+        first = (out_start + delay) * down - (len(h) - 1)
+        last = (out_stop - 1 + delay) * down
+        start = max(first // up // down * down, 0)
+        stop = min(last // up + 1, n_samples)
+
+        if one_dimension:
+            chunk = np.asarray(matrix[start:stop], dtype=dtype)[None, :]
+        else:
+            chunk = np.asarray(matrix[:, start:stop], dtype=dtype)
+        filtered = signal.upfirdn(h, chunk, up, down, axis=-1)
+        shift = delay - start * up // down
+        resampled[:, out_start:out_stop] = \
+            filtered[:, out_start + shift:out_stop + shift]
+
+    return resampled[0] if one_dimension else resampled
+
+
+def resample_multistage(matrix, fs, fs_new, chunk_size=DEFAULT_CHUNK_SIZE,
+                        dtype=np.float64, max_factor=DEFAULT_MAX_FACTOR):
+    """Resample channels from fs to fs_new in polyphase stages.
+
+    :param matrix: values with shape (channels, samples) or (samples,)
+    :param dtype: floating type of the computation, np.float32 halves memory
+    :return: resampled values and planned (up, down) stages
+    """
+
+    stages = plan_resampling(fs, fs_new, max_factor=max_factor)
+    resampled = matrix
+    for up, down in stages:
+        resampled = resample_poly_chunked(resampled, up, down,
+                                          chunk_size=chunk_size, dtype=dtype)
+    return resampled, stages
+
+
+def resample_signal(x, y, fs_new, **kwargs):
+    """Resample uniformly sampled y, at times x, to rate fs_new.
+
+    :return: times and values with the new rate
+    """
+
+    fs = (len(x) - 1) / (x[-1] - x[0])
+    y_new, _ = resample_multistage(y, fs, fs_new, **kwargs)
+    x_new = x[0] + np.arange(y_new.shape[-1]) / fs_new
+    return x_new, y_new
+
+
+if __name__ == "__main__":
+
+    import time
+
+    fs = 20e3 * 128
+    fs_new = 20e3
+    n_channels = 4
+    t = np.arange(int(fs * 0.5)) / fs
+    rng = np.random.default_rng(0)
+    values = np.sin(2 * np.pi * 1e3 * t) + 0.1 * rng.standard_normal(
+        (n_channels, len(t)))
+
+    print("Stages:", plan_resampling(fs, fs_new))
+
+    start = time.perf_counter()
+    resampled, _ = resample_multistage(values, fs, fs_new, dtype=np.float32)
+    print(f"Multistage float32: {time.perf_counter() - start:.3f} s, "
+          f"shape {resampled.shape}")
+
+    start = time.perf_counter()
+    reference = signal.decimate(signal.decimate(values, 16), 8)
+    print(f"Decimate twice: {time.perf_counter() - start:.3f} s")
+
+    chunked = resample_poly_chunked(values, 3, 128, chunk_size=10000)
+    print("Chunked equal to resample_poly:",
+          np.array_equal(chunked, signal.resample_poly(values, 3, 128,
+                                                       axis=-1)))
+
+    # Rational ratios in both directions keep tones of the passband
+    for fs_from, fs_to, tone in [(44.1e3, 48e3, 5e3), (48e3, 44.1e3, 8e3)]:
+        t_tone = np.arange(int(fs_from * 0.1)) / fs_from
+        sine = np.sin(2 * np.pi * tone * t_tone)
+        resampled_sine, stages = resample_multistage(sine, fs_from, fs_to)
+        ratio = Fraction(fs_to / fs_from).limit_denominator(1000)
+        poly_reference = signal.resample_poly(sine, ratio.numerator,
+                                              ratio.denominator)
+        inside = slice(len(poly_reference) // 10, -len(poly_reference) // 10)
+        print(f"{fs_from:.0f} Hz to {fs_to:.0f} Hz {stages}, close to "
+              f"resample_poly:",
+              np.allclose(resampled_sine[inside], poly_reference[inside],
+                          atol=1e-2))
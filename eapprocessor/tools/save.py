@@ -1,7 +1,11 @@
 from pathlib import Path
+import json
 import h5py
 import MEArec as mr
 import numpy as np
+from eapprocessor.hwsimulator.adc import NormalizedCodes
+from eapprocessor.tools.ragged import RaggedArray
+from eapprocessor.preprocessor.neo import StreamedNEO
 
 
 def save_converted_values(adcgen, filename=None, is_lcadc=False):
@@ -17,26 +21,22 @@ def save_converted_values_to_file(adcgen, f, is_lcadc=False):
 
     mr.save_dict_to_hdf5(adcgen["adcinfo"], f, 'adcinfo/')
     if is_lcadc:
-        idx_array = []
-        for idx, adc in enumerate(adcgen["lcadc"]):
-            if len(adc) > 0:
-                f.create_dataset('lcadc/' + str(idx),
-                                 data=list(adc))
-            if len(adcgen["indexes"][idx]) > 0:
-                f.create_dataset('indexes/' + str(idx),
-                                 data=list(adcgen["indexes"][idx]))
-            if len(adcgen["normalized"][idx]) > 0:
-                f.create_dataset('normalized/' + str(idx),
-                                 data=list(adcgen["normalized"][idx]))
-            idx_array += [idx]
-
-        if len(idx_array) > 0:
-            f.create_dataset("channels", data=idx_array)
+        lcadc = as_ragged(adcgen["lcadc"])
+        indexes = as_ragged(adcgen["indexes"])
+        f.create_dataset('offsets', data=lcadc.offsets)
+        f.create_dataset('lcadc', data=lcadc.values)
+        f.create_dataset('indexes', data=indexes.values)
+        if is_saved_normalized(adcgen):
+            f.create_dataset('normalized',
+                             data=as_ragged(adcgen["normalized"]).values)
+
+        if len(lcadc) > 0:
+            f.create_dataset("channels", data=np.arange(len(lcadc)))
 
     else:
         if len(adcgen["adc"]) > 0:
             f.create_dataset('adc', data=adcgen["adc"])
-        if len(adcgen["normalized"]) > 0:
+        if is_saved_normalized(adcgen) and len(adcgen["normalized"]) > 0:
             f.create_dataset('normalized', data=adcgen["normalized"])
 
     if adcgen["recordings"]:
@@ -44,6 +44,22 @@ def save_converted_values_to_file(adcgen, f, is_lcadc=False):
         mr.save_recording_to_file(recgen, f, path="recordings/")
 
 
+def is_saved_normalized(adcgen):
+
+    # Lazy normalized values are derived from codes again when loading
+    normalized = adcgen["normalized"]
+    if isinstance(normalized, RaggedArray):
+        normalized = normalized.values
+    return not isinstance(normalized, NormalizedCodes)
+
+
+def as_ragged(values):
+
+    if isinstance(values, RaggedArray):
+        return values
+    return RaggedArray.from_arrays(values)
+
+
 def save_neo_values(neogen, filename=None, is_lcadc=False):
     filename = Path(filename)
     filename.parent.mkdir(parents=True, exist_ok=True)
@@ -58,10 +74,14 @@ def save_neo_values_to_file(neogen, f, is_lcadc=False):
         f.create_dataset('w', data=neogen["w"])
 
     if is_lcadc:
+        # Channels of neo values share the offsets of converted values
         for w_idx, w_item in enumerate(neogen["neo"]):
-            for idx, item in enumerate(w_item):
-                f.create_dataset('neo/' + str(w_idx) + '/' + str(idx),
-                                 data=item)
+            f.create_dataset('neo/' + str(w_idx),
+                             data=as_ragged(w_item).values)
+
+    elif isinstance(neogen["neo"], StreamedNEO):
+        neo = neogen["neo"]
+        neo.write(f.create_dataset('neo', shape=neo.shape, dtype=neo.dtype))
 
     else:
         if len(neogen["neo"]) > 0:
@@ -70,6 +90,57 @@ def save_neo_values_to_file(neogen, f, is_lcadc=False):
     save_converted_values_to_file(neogen, f, is_lcadc=is_lcadc)
 
 
+def save_preprocessed_values_to_file(prepgen, f):
+
+    # NEO, codes and normalized values are written block by block
+    f.create_dataset('w', data=prepgen["w"])
+
+    mr.save_dict_to_hdf5(prepgen["adcinfo"], f, 'adcinfo/')
+    if prepgen["recordings"]:
+        mr.save_recording_to_file(prepgen["recordings"], f,
+                                  path="recordings/")
+
+
+def save_operator_values(opgen, filename=None):
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(filename, 'w') as f:
+        save_operator_values_to_file(opgen, f)
+
+
+def save_operator_values_to_file(opgen, f):
+
+    # Values of each operator with shape (parameters, channels, samples)
+    for name, values in opgen["operators"].items():
+        dataset = f.create_dataset('operators/' + name, data=values)
+        dataset.attrs["parameters"] = json.dumps(opgen["parameters"][name],
+                                                 default=int)
+
+    save_converted_values_to_file(opgen, f)
+
+
+def save_lcadc_sweep(sweep, filename=None):
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(filename, 'w') as f:
+        save_lcadc_sweep_to_file(sweep, f)
+
+
+def save_lcadc_sweep_to_file(sweep, f):
+
+    for key in ["voltage_ref", "resolution", "hysteresis"]:
+        f.create_dataset('configurations/' + key, data=sweep[key])
+    f.create_dataset('channels', data=sweep["channels"])
+    f.create_dataset('counts', data=sweep["counts"])
+    f.create_dataset('offsets', data=sweep["lcadc"].offsets)
+    f.create_dataset('lcadc', data=sweep["lcadc"].values)
+    f.create_dataset('indexes', data=sweep["indexes"].values)
+    if "adcinfo" in sweep:
+        mr.save_dict_to_hdf5(sweep["adcinfo"], f, 'adcinfo/')
+
+
 def save_array(array, filename=None, path='array'):
     filename = Path(filename)
     filename.parent.mkdir(parents=True, exist_ok=True)